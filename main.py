@@ -1,19 +1,24 @@
 import os
 import time
+import io
+import asyncio
+import logging
+import tempfile
+import threading
 import shutil
 import zipfile
 import datetime
 import base64
-from os import listdir
 from os.path import isfile, join
 from functools import partial
 from dotenv import load_dotenv
-from nicegui import ui, events, app
+from nicegui import ui, events, app, Client
 from fastapi import FastAPI, UploadFile, File, Request
 from fastapi.responses import JSONResponse
 
 from data.const import LANGUAGES, INVERTED_LANGUAGES
 from src.util import time_estimate
+from src import jobs, scheduler, cache, estimator, media, transcript
 from src.help import (
     help as help_page,
 )  # Renamed to avoid conflict with built-in help function
@@ -31,78 +36,243 @@ SSL_CERTFILE = os.getenv("SSL_CERTFILE")
 SSL_KEYFILE = os.getenv("SSL_KEYFILE")
 SUMMARIZATION = os.getenv("SUMMARIZATION") == "True"
 API_KEY = os.getenv("API_KEY", "")  # Optional API key for authentication
+# Uploads are written here until they are complete, then moved into data/in
+UPLOAD_DIR = join(ROOT, "data", "upload")
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Seconds between two checks of the job index for changes by the status broadcaster
+STATUS_INTERVAL = float(os.getenv("STATUS_INTERVAL", "0.25"))
 
 if WINDOWS:
     os.environ["PATH"] += os.pathsep + "ffmpeg/bin"
     os.environ["PATH"] += os.pathsep + "ffmpeg"
 
+logger = logging.getLogger(__name__)
+
 BACKSLASHCHAR = "\\"
 user_storage = {}
+# Open pages per user, client id -> (client, function that redraws the changed parts of the page)
+subscribers = {}
+# File list of each user as last sent to the open pages
+broadcast_file_lists = {}
+# Held while a free file name is chosen and the upload is moved there
+upload_lock = threading.Lock()
+
+# Stages of the worker as shown to the user
+STAGE_NAMES = {
+    "ingest": "Datei wird konvertiert",
+    "asr": "Sprache wird erkannt",
+    "align": "Zeitstempel werden berechnet",
+    "diarize": "Sprecher werden erkannt",
+    "render": "Editor wird erstellt",
+}
+
+
+def job_estimate(job):
+    """Return the estimated run time of a job. Files are probed at upload, polling never runs ffprobe."""
+    if job["estimated_time"] is not None:
+        return job["estimated_time"]
+    if job["duration"] is not None:
+        # Estimated again after the estimator learned from a finished job
+        estimated_time = estimator.estimate(job["duration"])
+        jobs.set_estimate(job["user_id"], job["file_name"], estimated_time)
+        return estimated_time
+    estimated_time, run_time = time_estimate(join(ROOT, "data", "in", job["user_id"], job["file_name"]))
+    if estimated_time == -1:
+        return 0
+    jobs.set_estimate(job["user_id"], job["file_name"], estimated_time, run_time)
+    return estimated_time
+
+
+def file_status(job, waits, now=None):
+    """Return the status of a job as shown to the user.
+
+    The status is [file name, text, progress in percent or -1 after an error, estimated time, upload time].
+    """
+    f = job["file_name"]
+    if job["status"] == jobs.DONE:
+        return [f, "Datei transkribiert", 100.0, 0, job["created"]]
+    if job["status"] == jobs.ERROR:
+        return [f, job["error_message"] or "Transkription fehlgeschlagen", -1, 0, job["created"]]
+    if job["status"] == jobs.PROCESSING:
+        progress, estimated_time_left = scheduler.job_progress(job, now)
+        estimated_time_left = round(estimated_time_left)
+        stage = STAGE_NAMES.get(job["stage"], "Datei wird transkribiert")
+        return [
+            f,
+            f"{stage}. Geschätzte Bearbeitungszeit: {datetime.timedelta(seconds=estimated_time_left)}",
+            progress * 100,
+            estimated_time_left,
+            job["created"],
+        ]
+    estimated_time = job_estimate(job)
+    wait_time_str = str(datetime.timedelta(seconds=round(waits.get(job["id"], 0) + estimated_time)))
+    return [f, "Datei in Warteschlange. Geschätzte Wartezeit: " + wait_time_str, 0.0, estimated_time, job["created"]]
+
+
+def list_files(user_id, waits=None):
+    """Return the status of all files of the user from the job index. Blocks, so run it in a thread."""
+    if waits is None:
+        waits = scheduler.estimate_waits(jobs.get_queue())
+    now = time.time()
+    return sorted(file_status(job, waits, now) for job in jobs.get_jobs(user_id))
+
+
+def store_files(user_id, file_list):
+    """Keep the status of the files of the user for the page. Call it on the event loop, the page reads it there."""
+    for status in file_list:
+        if status[2] == -1:
+            user_storage[user_id]["known_errors"].add(status[0])
+    user_storage[user_id]["file_list"] = file_list
+
+
+async def read_files(user_id):
+    """Read the status of all files of the user from the job index."""
+    store_files(user_id, await asyncio.to_thread(list_files, user_id))
+
+
+def queue_view(file_list):
+    return [file_status for file_status in file_list if 0 <= file_status[2] < 100.0]
+
+
+def results_view(file_list):
+    return [file_status[:3] for file_status in file_list if file_status[2] >= 100.0 or file_status[2] == -1]
+
+
+def collect_summaries():
+    """Make the summaries the worker wrote available for download. Return the names of their files by user."""
+    found = {}
+    for job in jobs.get_written_summaries():
+        out_file = join(ROOT, "data", "out", job["user_id"], job["file_name"])
+        try:
+            os.replace(out_file + ".summary", out_file + ".htmlsummary")
+        except FileNotFoundError:
+            # Deleted by the user in the meantime
+            pass
+        jobs.set_summary(job["user_id"], job["file_name"], jobs.SUMMARY_READY)
+        found.setdefault(job["user_id"], []).append(job["file_name"])
+    return found
+
+
+def read_status(user_ids):
+    """Read the files of the users and the finished summaries from the job index. Blocks, so run it in a thread."""
+    waits = scheduler.estimate_waits(jobs.get_queue())
+    return {user_id: list_files(user_id, waits) for user_id in user_ids}, collect_summaries()
+
+
+async def broadcast_status():
+    """Push the changes of the job index to all open pages.
+
+    A round only checks the version of the job index, which every change of a job increases. Only after a
+    change is the index read, once for all open pages, and only the pages whose files changed are redrawn.
+    The job index is read in a thread, so that the pages stay responsive.
+    """
+    version = None
+    while True:
+        await asyncio.sleep(STATUS_INTERVAL)
+        try:
+            for user_id, pages in list(subscribers.items()):
+                # Pages whose browser tab was closed
+                for client_id in [client_id for client_id in pages if client_id not in Client.instances]:
+                    del pages[client_id]
+                if not pages:
+                    del subscribers[user_id]
+                    broadcast_file_lists.pop(user_id, None)
+            if not subscribers:
+                continue
+            current_version = await asyncio.to_thread(jobs.get_version)
+            if current_version == version:
+                continue
+            version = current_version
+
+            file_lists, summaries = await asyncio.to_thread(read_status, list(subscribers))
+            for user_id, new_file_list in file_lists.items():
+                if user_id not in subscribers:
+                    continue
+                store_files(user_id, new_file_list)
+                old_file_list = broadcast_file_lists.get(user_id, [])
+                broadcast_file_lists[user_id] = new_file_list
+                refresh_queue = queue_view(old_file_list) != queue_view(new_file_list)
+                refresh_results = results_view(old_file_list) != results_view(new_file_list)
+                user_summaries = summaries.get(user_id, [])
+                if not refresh_queue and not refresh_results and not user_summaries:
+                    continue
+                for client, show_changes in list(subscribers[user_id].values()):
+                    if client.id not in Client.instances:
+                        continue
+                    with client:
+                        show_changes(refresh_queue, refresh_results, user_summaries)
+        except Exception:
+            logger.exception("Could not broadcast the job status")
+
+
+def detach_upload(source):
+    """Return a file object of an upload that stays readable after the request that received it has ended.
+
+    Call it before the first await of the handler, while the web framework has not closed the upload yet.
+    """
+    try:
+        fd = os.dup(source.fileno())
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        # Kept in memory by the web framework, so it is small
+        return io.BytesIO(source.read())
+    os.lseek(fd, 0, os.SEEK_SET)
+    return os.fdopen(fd, "rb")
+
+
+def receive_upload(source):
+    """Stream an upload in chunks into a temporary file and hash it on the way. Return the file and the hash.
+
+    Blocks, so run it in a thread. The memory use does not depend on the size of the upload.
+    """
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    hasher = cache.new_hasher()
+    fd, tmp_file = tempfile.mkstemp(dir=UPLOAD_DIR, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in iter(lambda: source.read(UPLOAD_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+    return tmp_file, hasher.hexdigest()
+
+
+def free_file_name(in_path, file_name):
+    """Return the file name, numbered if the user already has a file with that name, or None if none is free."""
+    original_file_name = file_name
+    for i in range(1, 10001):
+        if isfile(join(in_path, file_name)):
+            name, ext = os.path.splitext(original_file_name)
+            file_name = f"{name}_{i}{ext}"
+        else:
+            return file_name
+    return None
 
 
-def read_files(user_id):
-    """Read in all files of the user and set the file status if known."""
-    user_storage[user_id]["file_list"] = []
-    in_path = join(ROOT, "data", "in", user_id)
-    out_path = join(ROOT, "data", "out", user_id)
-    error_path = join(ROOT, "data", "error", user_id)
+def place_upload(tmp_file, in_path, file_name, keep_name=False, register=None):
+    """Move a received upload into data/in in one step, so that the worker never sees a partial file.
 
-    if os.path.exists(in_path):
-        for f in listdir(in_path):
-            if isfile(join(in_path, f)) and f != "hotwords.txt" and f != "language.txt":
-                file_status = [
-                    f,
-                    "Datei in Warteschlange. Geschätzte Wartezeit: ",
-                    0.0,
-                    0,
-                    os.path.getmtime(join(in_path, f)),
-                ]
-                if isfile(join(out_path, f + ".html")):
-                    file_status[1] = "Datei transkribiert"
-                    file_status[2] = 100.0
-                    file_status[3] = 0
-                else:
-                    estimated_time, _ = time_estimate(join(in_path, f), ONLINE)
-                    if estimated_time == -1:
-                        estimated_time = 0
-                    file_status[3] = estimated_time
-
-                user_storage[user_id]["file_list"].append(file_status)
-
-        files_in_queue = []
-        for u in user_storage:
-            for f in user_storage[u].get("file_list", []):
-                if (
-                    "updates" in user_storage[u]
-                    and len(user_storage[u]["updates"]) > 0
-                    and user_storage[u]["updates"][0] == f[0]
-                ):
-                    f = user_storage[u]["updates"]
-                if f[2] < 100.0:
-                    files_in_queue.append(f)
+    The file gets a free name unless keep_name is set. register(file_name) is called right before the file
+    appears, so that the worker finds its job with the options of the upload. Return the name of the file,
+    or None if no name is free.
+    """
+    os.makedirs(in_path, exist_ok=True)
+    with upload_lock:
+        if not keep_name:
+            file_name = free_file_name(in_path, file_name)
+        if file_name is None:
+            os.remove(tmp_file)
+            return None
+        if register is not None:
+            register(file_name)
+        os.replace(tmp_file, join(in_path, file_name))
+    return file_name
 
-        for file_status in user_storage[user_id]["file_list"]:
-            estimated_wait_time = sum(f[3] for f in files_in_queue if f[4] < file_status[4])
-            if file_status[2] < 100.0:
-                wait_time_str = str(datetime.timedelta(seconds=round(estimated_wait_time + file_status[3])))
-                file_status[1] += wait_time_str
 
-    if os.path.exists(error_path):
-        for f in listdir(error_path):
-            if isfile(join(error_path, f)) and not f.endswith(".txt"):
-                text = "Transkription fehlgeschlagen"
-                error_file = join(error_path, f + ".txt")
-                if isfile(error_file):
-                    with open(error_file, "r") as txtf:
-                        content = txtf.read()
-                        if content:
-                            text = content
-                file_status = [f, text, -1, 0, os.path.getmtime(join(error_path, f))]
-                if f not in user_storage[user_id]["known_errors"]:
-                    user_storage[user_id]["known_errors"].add(f)
-                user_storage[user_id]["file_list"].append(file_status)
-
-    user_storage[user_id]["file_list"].sort()
+def estimate_upload(user_id, file_name):
+    """Probe an upload once, the queue and the worker use the cached result."""
+    job_estimate(jobs.get_job(user_id, file_name))
 
 
 async def handle_upload(e: events.UploadEventArguments, user_id):
@@ -127,91 +297,35 @@ async def handle_upload(e: events.UploadEventArguments, user_id):
         if os.path.exists(error_txt_file):
             os.remove(error_txt_file)
 
-    # Ensure unique file names
-    original_file_name = file_name
-    for i in range(1, 10001):
-        if isfile(join(in_path, file_name)):
-            name, ext = os.path.splitext(original_file_name)
-            file_name = f"{name}_{i}{ext}"
-        else:
-            break
-    else:
+    hotwords_content = app.storage.user.get(f"{user_id}_vocab", "").strip()
+    language = app.storage.user.get(f"{user_id}_language", "").strip() or "de"
+
+    # Save the uploaded file in a thread, the event loop keeps serving other requests. The upload is
+    # detached before the first await, later the web framework may have closed it.
+    source = detach_upload(e.content)
+    try:
+        tmp_file, content_hash = await asyncio.to_thread(receive_upload, source)
+    finally:
+        source.close()
+    register = partial(
+        jobs.register_job, user_id, language=language, hotwords=hotwords_content or None, content_hash=content_hash
+    )
+    file_name = await asyncio.to_thread(place_upload, tmp_file, in_path, file_name, False, register)
+    if file_name is None:
         ui.notify("Zu viele Dateien mit dem gleichen Namen.")
         return
 
-    # Save hotwords if provided
-    hotwords_content = app.storage.user.get(f"{user_id}_vocab", "").strip()
-    hotwords_file = join(in_path, "hotwords.txt")
-    if hotwords_content:
-        with open(hotwords_file, "w") as f:
-            f.write(hotwords_content)
-    elif isfile(hotwords_file):
-        os.remove(hotwords_file)
-
-    # Save the selected language
-    language = app.storage.user.get(f"{user_id}_language", "").strip()
-    language_file = join(in_path, "language.txt")
-    if language:
-        with open(language_file, "w") as f:
-            f.write(language)
-    else:
-        with open(language_file, "w") as f:
-            f.write("de")
-
-    # Save the uploaded file
-    with open(join(in_path, file_name), "wb") as f:
-        f.write(e.content.read())
-
-async def handle_upload_api(file_content, file_name, user_id, hotwords=None):
-    """Save the uploaded file from API to disk."""
-    in_path = join(ROOT, "data", "in", user_id)
-    out_path = join(ROOT, "data", "out", user_id)
-    error_path = join(ROOT, "data", "error", user_id)
-
-    os.makedirs(in_path, exist_ok=True)
-    os.makedirs(out_path, exist_ok=True)
-
-    # Clean up error files if re-uploading
-    if os.path.exists(error_path):
-        error_file = join(error_path, file_name)
-        error_txt_file = error_file + ".txt"
-        if os.path.exists(error_file):
-            os.remove(error_file)
-        if os.path.exists(error_txt_file):
-            os.remove(error_txt_file)
-
-    # Ensure unique file names
-    original_file_name = file_name
-    for i in range(1, 10001):
-        if isfile(join(in_path, file_name)):
-            name, ext = os.path.splitext(original_file_name)
-            file_name = f"{name}_{i}{ext}"
-        else:
-            break
-    else:
-        return None, "Too many files with the same name"
-
-    # Save hotwords if provided
-    if hotwords:
-        hotwords_file = join(in_path, "hotwords.txt")
-        with open(hotwords_file, "w") as f:
-            f.write(hotwords)
-
-    # Save the uploaded file
-    with open(join(in_path, file_name), "wb") as f:
-        f.write(file_content)
-    
-    return file_name, None
+    await asyncio.to_thread(estimate_upload, user_id, file_name)
 
 
 def handle_reject(e: events.GenericEventArguments):
     ui.notify("Ungültige Datei. Es können nur Audio/Video-Dateien unter 12GB transkribiert werden.")
 
 
-def handle_added(e: events.GenericEventArguments, user_id, upload_element, refresh_file_view):
+async def handle_added(e: events.GenericEventArguments, user_id, upload_element, refresh_file_view):
     """After a file was added, refresh the GUI."""
     upload_element.run_method("removeUploadedFiles")
-    refresh_file_view(user_id=user_id, refresh_queue=True, refresh_results=False)
+    await refresh_file_view(user_id=user_id, refresh_queue=True, refresh_results=False)
 
 
 def prepare_download(file_name, user_id):
@@ -315,75 +429,24 @@ async def download_all(user_id):
     ui.download(zip_file_path)
 
 
-def delete_file(file_name, user_id, refresh_file_view):
+async def delete_file(file_name, user_id, refresh_file_view):
     paths_to_delete = [
         join(ROOT, "data", "in", user_id, file_name),
         join(ROOT, "data", "error", user_id, file_name),
         join(ROOT, "data", "error", user_id, file_name + ".txt"),
     ]
-    suffixes = ["", ".txt", ".html", ".mp4", ".srt", ".htmlupdate", ".htmlfinal"]
+    suffixes = ["", ".txt", ".html", ".mp4", ".srt", ".jsonl", ".htmlupdate", ".htmlfinal"]
     for suffix in suffixes:
         paths_to_delete.append(join(ROOT, "data", "out", user_id, file_name + suffix))
 
     for path in paths_to_delete:
         if os.path.exists(path):
             os.remove(path)
+    jobs.delete_job(user_id, file_name)
+    media.forget(join(ROOT, "data", "in", user_id, file_name))
+    user_storage[user_id]["known_errors"].discard(file_name)
 
-    refresh_file_view(user_id=user_id, refresh_queue=True, refresh_results=True)
-
-
-def listen(user_id, refresh_file_view):
-    """Periodically check if a file is being transcribed and calculate its estimated progress."""
-    worker_user_dir = join(ROOT, "data", "worker", user_id)
-
-    if os.path.exists(worker_user_dir):
-        for f in listdir(worker_user_dir):
-            if isfile(join(worker_user_dir, f)):
-                parts = f.split("_")
-                if len(parts) < 3:
-                    continue
-                estimated_time = float(parts[0])
-                start = float(parts[1])
-                file_name = "_".join(parts[2:])
-                progress = min(0.975, (time.time() - start) / estimated_time)
-                estimated_time_left = round(max(1, estimated_time - (time.time() - start)))
-
-                in_file = join(ROOT, "data", "in", user_id, file_name)
-                if os.path.exists(in_file):
-                    user_storage[user_id]["updates"] = [
-                        file_name,
-                        f"Datei wird transkribiert. Geschätzte Bearbeitungszeit: {datetime.timedelta(seconds=estimated_time_left)}",
-                        progress * 100,
-                        estimated_time_left,
-                        os.path.getmtime(in_file),
-                    ]
-                else:
-                    os.remove(join(worker_user_dir, f))
-                refresh_file_view(
-                    user_id=user_id,
-                    refresh_queue=True,
-                    refresh_results=(user_storage[user_id].get("file_in_progress") != file_name),
-                )
-                user_storage[user_id]["file_in_progress"] = file_name
-                return
-
-        # No files being processed
-        if user_storage[user_id].get("updates"):
-            user_storage[user_id]["updates"] = []
-            user_storage[user_id]["file_in_progress"] = None
-            refresh_file_view(user_id=user_id, refresh_queue=True, refresh_results=True)
-        else:
-            refresh_file_view(user_id=user_id, refresh_queue=True, refresh_results=False)
-
-    out_user_dir = join(ROOT, "data", "out", user_id)
-    if os.path.exists(out_user_dir):
-        for f in listdir(out_user_dir):
-            if isfile(join(out_user_dir, f)) and f.endswith(".summary"):
-                os.rename(
-                    join(out_user_dir, f),
-                    join(out_user_dir, f).replace(".summary", ".htmlsummary"),
-                )
-                refresh_file_view(user_id, False, True)
+    await refresh_file_view(user_id=user_id, refresh_queue=True, refresh_results=True)
 
 
 def update_hotwords(user_id):
@@ -421,6 +484,12 @@ return content.slice({i * 500_000}, {(i + 1) * 500_000});
         with open(update_file, "w", encoding="utf-8") as f:
             f.write(content.strip())
 
+        # The exports are rendered from the transcript file, so the changes are written back to it
+        out_base = full_file_name[: -len(".html")]
+        segments = await asyncio.to_thread(transcript.apply_editor, out_base + ".jsonl", content)
+        with open(out_base + ".srt", "w", encoding="utf-8") as f:
+            f.write(transcript.render_srt(segments))
+
         ui.notify("Änderungen gespeichert.")
 
     user_id = str(app.storage.browser.get("id", "local")) if ONLINE else "local"
@@ -474,136 +543,182 @@ async def download_summary(file_name, user_id):
     )
 
 
-@ui.page("/")
-async def main_page():
-    """Main page of the application."""
+def escape_file_name(file_name):
+    return file_name.replace("_", BACKSLASHCHAR + "_")
 
-    def refresh_file_view(user_id, refresh_queue, refresh_results):
-        num_errors = len(user_storage[user_id]["known_errors"])
-        read_files(user_id)
-        if refresh_queue:
-            display_queue.refresh(user_id=user_id)
-        if refresh_results or num_errors < len(user_storage[user_id]["known_errors"]):
-            display_results.refresh(user_id=user_id)
-
-    @ui.refreshable
-    def display_queue(user_id):
-        for file_status in sorted(user_storage[user_id]["file_list"], key=lambda x: (x[2], -x[4], x[0])):
-            if user_storage[user_id].get("updates") and user_storage[user_id]["updates"][0] == file_status[0]:
-                file_status = user_storage[user_id]["updates"]
-            if 0 <= file_status[2] < 100.0:
-                ui.markdown(f"<b>{file_status[0].replace('_', BACKSLASHCHAR + '_')}:</b> {file_status[1]}")
-                ui.linear_progress(value=file_status[2] / 100, show_value=False, size="10px").props("instant-feedback")
-                ui.separator()
-
-    async def summarize(file_name, user_id):
-        if os.path.isfile(join(ROOT + "data/out", user_id, file_name + ".htmlsummary")):
-            os.remove(join(ROOT + "data/out", user_id, file_name + ".htmlsummary"))
-        if os.path.isfile(join(ROOT + "data/out", user_id, file_name + ".todosummary")):
-            os.remove(join(ROOT + "data/out", user_id, file_name + ".todosummary"))
-
-        prepare_download(file_name, user_id)
-        os.rename(
-            join(ROOT + "data/out/" + user_id, file_name + ".htmlfinal"),
-            join(ROOT + "data/out/" + user_id, file_name + ".todosummary"),
-        )
 
-        refresh_file_view(user_id, False, True)
+def update_rows(container, rows, statuses, create):
+    """Update a list of files on the page in place.
 
-    @ui.refreshable
-    def display_results(user_id):
-        any_file_ready = False
-        for file_status in sorted(user_storage[user_id]["file_list"], key=lambda x: (x[2], -x[4], x[0])):
-            if user_storage[user_id].get("updates") and user_storage[user_id]["updates"][0] == file_status[0]:
-                file_status = user_storage[user_id]["updates"]
+    rows maps file names to their rows. Rows of new files are created, rows of removed files deleted and
+    the other rows only change what differs from their last status, so that a round costs O(changed)
+    messages to the browser.
+    """
+    names = [file_status[0] for file_status in statuses]
+    for file_name in set(rows) - set(names):
+        rows.pop(file_name).element.delete()
+    for file_status in statuses:
+        row = rows.get(file_status[0])
+        if row is None:
+            with container:
+                rows[file_status[0]] = create(file_status)
+        else:
+            row.update(file_status)
+
+    # Rows only move if the order of the files changed
+    order = [child.id for child in container.default_slot.children]
+    for index, file_name in enumerate(names):
+        element = rows[file_name].element
+        if order[index] != element.id:
+            element.move(container, index)
+            order.remove(element.id)
+            order.insert(index, element.id)
+
+
+class QueueRow:
+    """A queued or processing file on the page."""
+
+    def __init__(self, file_status):
+        self.file_status = file_status
+        with ui.column().classes("w-full") as self.element:
+            self.label = ui.markdown(f"<b>{escape_file_name(file_status[0])}:</b> {file_status[1]}")
+            self.progress = ui.linear_progress(value=file_status[2] / 100, show_value=False, size="10px").props(
+                "instant-feedback"
+            )
+            ui.separator()
+
+    def update(self, file_status):
+        if file_status[1] != self.file_status[1]:
+            self.label.set_content(f"<b>{escape_file_name(file_status[0])}:</b> {file_status[1]}")
+        if file_status[2] != self.file_status[2]:
+            self.progress.set_value(file_status[2] / 100)
+        self.file_status = file_status
+
+
+class ResultRow:
+    """A transcribed or failed file on the page. It is only rebuilt if its status changes."""
+
+    def __init__(self, file_status, user_id, refresh_file_view, summarize):
+        self.user_id = user_id
+        self.refresh_file_view = refresh_file_view
+        self.summarize = summarize
+        self.file_status = None
+        self.summary_create = None
+        self.summary_download = None
+        self.summary_label = None
+        self.element = ui.column().classes("w-full")
+        self.update(file_status)
+
+    def update(self, file_status):
+        if self.file_status is not None and file_status[:3] == self.file_status[:3]:
+            self.file_status = file_status
+            return
+        self.file_status = file_status
+        file_name = file_status[0]
+        delete = partial(delete_file, file_name=file_name, user_id=self.user_id, refresh_file_view=self.refresh_file_view)
+
+        self.element.clear()
+        with self.element:
             if file_status[2] >= 100.0:
-                ui.markdown(f"<b>{file_status[0].replace('_', BACKSLASHCHAR + '_')}</b>")
+                ui.markdown(f"<b>{escape_file_name(file_name)}</b>")
                 with ui.row():
                     ui.button(
                         "Editor herunterladen (Lokal)",
-                        on_click=partial(download_editor, file_name=file_status[0], user_id=user_id),
+                        on_click=partial(download_editor, file_name=file_name, user_id=self.user_id),
                     ).props("no-caps")
                     ui.button(
                         "Editor öffnen (Server)",
-                        on_click=partial(open_editor, file_name=file_status[0], user_id=user_id),
+                        on_click=partial(open_editor, file_name=file_name, user_id=self.user_id),
                     ).props("no-caps")
                     ui.button(
                         "SRT-Datei",
-                        on_click=partial(download_srt, file_name=file_status[0], user_id=user_id),
-                    ).props("no-caps")
-                    ui.button(
-                        "Datei entfernen",
-                        on_click=partial(
-                            delete_file,
-                            file_name=file_status[0],
-                            user_id=user_id,
-                            refresh_file_view=refresh_file_view,
-                        ),
-                        color="red-5",
+                        on_click=partial(download_srt, file_name=file_name, user_id=self.user_id),
                     ).props("no-caps")
-                    any_file_ready = True
+                    ui.button("Datei entfernen", on_click=delete, color="red-5").props("no-caps")
                 if SUMMARIZATION:
                     with ui.row():
-                        summary_create = ui.button(
+                        self.summary_create = ui.button(
                             "Zusammenfassung erstellen",
-                            on_click=partial(
-                                summarize, file_name=file_status[0], user_id=user_id
-                            ),
+                            on_click=partial(self.summarize, file_name=file_name, user_id=self.user_id),
                         ).props("no-caps")
-                        summary_create.disable()
-                        summary_download = ui.button(
+                        self.summary_download = ui.button(
                             "Zusammenfassung herunterladen",
-                            on_click=partial(
-                                download_summary,
-                                file_name=file_status[0],
-                                user_id=user_id,
-                            ),
+                            on_click=partial(download_summary, file_name=file_name, user_id=self.user_id),
                         ).props("no-caps")
-                        summary_download.disable()
+                        self.summary_label = ui.label("in Bearbeitung")
+                    self.update_summary()
+            else:
+                ui.markdown(f"<b>{escape_file_name(file_name)}:</b> {file_status[1]}")
+                ui.button("Datei entfernen", on_click=delete, color="red-5").props("no-caps")
+            ui.separator()
+
+    def update_summary(self):
+        """Enable the summary buttons according to the summary files of the worker."""
+        if self.summary_create is None:
+            return
+        out_file = join(ROOT, "data", "out", self.user_id, self.file_status[0])
+        in_progress = isfile(out_file + ".todosummary") or isfile(out_file + ".summarizing")
+        self.summary_download.set_enabled(isfile(out_file + ".htmlsummary"))
+        self.summary_create.set_enabled(not in_progress)
+        self.summary_label.set_visibility(in_progress)
 
-                        if os.path.isfile(
-                            join(
-                                ROOT + "data/out",
-                                user_id,
-                                file_status[0] + ".htmlsummary",
-                            )
-                        ):
-                            summary_download.enable()
-                        if not os.path.isfile(
-                            join(
-                                ROOT + "data/out",
-                                user_id,
-                                file_status[0] + ".todosummary",
-                            )
-                        ):
-                            summary_create.enable()
-                        else:
-                            ui.label("in Bearbeitung")
-                ui.separator()
-            elif file_status[2] == -1:
-                ui.markdown(f"<b>{file_status[0].replace('_', BACKSLASHCHAR + '_')}:</b> {file_status[1]}")
-                ui.button(
-                    "Datei entfernen",
-                    on_click=partial(
-                        delete_file,
-                        file_name=file_status[0],
-                        user_id=user_id,
-                        refresh_file_view=refresh_file_view,
-                    ),
-                    color="red-5",
-                ).props("no-caps")
-                ui.separator()
-        if any_file_ready:
-            ui.button(
+
+@ui.page("/")
+async def main_page(client: Client):
+    """Main page of the application."""
+
+    queue_rows = {}
+    result_rows = {}
+
+    async def refresh_file_view(user_id, refresh_queue, refresh_results):
+        num_errors = len(user_storage[user_id]["known_errors"])
+        await read_files(user_id)
+        show_changes(refresh_queue, refresh_results or num_errors < len(user_storage[user_id]["known_errors"]))
+
+    def show_changes(refresh_queue, refresh_results, summaries=()):
+        """Bring the rows of the page up to date. Only rows of files whose status changed are sent to the browser."""
+        file_list = sorted(user_storage[user_id]["file_list"], key=lambda x: (x[2], -x[4], x[0]))
+        if refresh_queue:
+            update_rows(queue_container, queue_rows, queue_view(file_list), QueueRow)
+        if refresh_results:
+            update_rows(
+                results_container,
+                result_rows,
+                [file_status for file_status in file_list if file_status[2] >= 100.0 or file_status[2] == -1],
+                lambda file_status: ResultRow(file_status, user_id, refresh_file_view, summarize),
+            )
+            download_all_button.set_visibility(any(row.file_status[2] >= 100.0 for row in result_rows.values()))
+        for file_name in summaries:
+            if file_name in result_rows:
+                result_rows[file_name].update_summary()
+
+    async def summarize(file_name, user_id):
+        out_user_dir = join(ROOT, "data", "out", user_id)
+        if os.path.isfile(join(out_user_dir, file_name + ".htmlsummary")):
+            os.remove(join(out_user_dir, file_name + ".htmlsummary"))
+        if os.path.isfile(join(out_user_dir, file_name + ".todosummary")):
+            os.remove(join(out_user_dir, file_name + ".todosummary"))
+
+        prepare_download(file_name, user_id)
+        os.rename(
+            join(out_user_dir, file_name + ".htmlfinal"),
+            join(out_user_dir, file_name + ".todosummary"),
+        )
+
+        show_changes(False, False, summaries=[file_name])
+
+    def display_files(user_id):
+        nonlocal queue_container, results_container, download_all_button
+        with ui.card().classes("border p-4").style("width: min(60vw, 700px);"):
+            queue_container = ui.column().classes("w-full")
+            results_container = ui.column().classes("w-full")
+            download_all_button = ui.button(
                 "Alle Dateien herunterladen",
                 on_click=partial(download_all, user_id=user_id),
             ).props("no-caps")
+        show_changes(True, True)
 
-    def display_files(user_id):
-        read_files(user_id)
-        with ui.card().classes("border p-4").style("width: min(60vw, 700px);"):
-            display_queue(user_id=user_id)
-            display_results(user_id=user_id)
+    queue_container = results_container = download_all_button = None
 
     if ONLINE:
         user_id = str(app.storage.browser.get("id", ""))
@@ -615,7 +730,6 @@ async def main_page():
         "file_list": [],
         "content": "",
         "content_filename": "",
-        "file_in_progress": None,
         "known_errors": set(),
     }
 
@@ -623,7 +737,9 @@ async def main_page():
     if os.path.exists(in_user_tmp_dir):
         shutil.rmtree(in_user_tmp_dir)
 
-    read_files(user_id)
+    await read_files(user_id)
+    # The status broadcaster redraws the page when the files of the user change
+    subscribers.setdefault(user_id, {})[client.id] = (client, show_changes)
 
     with ui.column():
         with ui.header(elevated=True).style("background-color: #0070b4;").props("fit=scale-down").classes("q-pa-xs-xs"):
@@ -658,10 +774,6 @@ async def main_page():
                         )
 
                 ui.label("")
-                ui.timer(
-                    2,
-                    partial(listen, user_id=user_id, refresh_file_view=refresh_file_view),
-                )
 
                 language = "deutsch"
                 if (
@@ -710,6 +822,10 @@ def init_app():
     # Add API routes
     router = get_api_router()
     app.router.include_router(router)
+    # Uploads that were interrupted by a restart
+    shutil.rmtree(UPLOAD_DIR, ignore_errors=True)
+    # One task reads the job status for all open pages
+    app.on_startup(broadcast_status)
     # use add_api_route instead
 #    @app.fastapi.middleware("http")
 #    async def add_cors_headers(request: Request, call_next):
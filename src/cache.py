@@ -0,0 +1,130 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+
+from os.path import join, isfile, isdir
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ROOT = os.getenv("ROOT")
+DEVICE = os.getenv("DEVICE")
+STORAGE_SECRET = os.getenv("STORAGE_SECRET", "default_salt")
+RESULT_CACHE = os.getenv("RESULT_CACHE", "True") == "True"
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR") or join(ROOT, "data", "cache")
+# Disk budget of the cached results in MB, the least recently used results are removed first
+RESULT_CACHE_MB = int(os.getenv("RESULT_CACHE_MB", "20480"))
+# Part of the cache key, change it to invalidate the cache after changing the models
+MODEL_VERSION = os.getenv(
+    "MODEL_VERSION", "mlx-whisper-large-v3" if DEVICE == "mps" else "whisperx-3.2.0-large-v3"
+)
+
+logger = logging.getLogger(__name__)
+
+SEGMENTS_FILE = "segments.json"
+SRT_FILE = "transcript.srt"
+PREVIEW_FILE = "preview.mp4"
+
+
+def new_hasher():
+    """Return a SHA-256 salted with STORAGE_SECRET, the same hash the API uses for its job ids."""
+    hasher = hashlib.sha256()
+    hasher.update(STORAGE_SECRET.encode())
+    return hasher
+
+
+def hash_content(content):
+    hasher = new_hasher()
+    hasher.update(content)
+    return hasher.hexdigest()
+
+
+def hash_file(file_name, chunk_size=1024 * 1024):
+    hasher = new_hasher()
+    with open(file_name, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def result_key(content_hash, language, hotwords):
+    """Return the cache key of a transcription of the given content with the given options."""
+    options = json.dumps([content_hash, language, hotwords, MODEL_VERSION])
+    return hashlib.sha256(options.encode()).hexdigest()
+
+
+def lookup(key):
+    """Return the cached segments, SRT and preview file of a key, or None if the result is not cached."""
+    if not RESULT_CACHE:
+        return None
+    entry = join(RESULT_CACHE_DIR, key)
+    try:
+        with open(join(entry, SEGMENTS_FILE), "r", encoding="utf-8") as f:
+            segments = json.load(f)
+        with open(join(entry, SRT_FILE), "r", encoding="utf-8") as f:
+            srt = f.read()
+        # The modification time of the entry is the time of its last use
+        os.utime(entry)
+    except (OSError, ValueError):
+        return None
+    preview_file = join(entry, PREVIEW_FILE)
+    return segments, srt, preview_file if isfile(preview_file) else None
+
+
+def store(key, segments, srt, preview_file=None):
+    """Add a result to the cache and remove the least recently used results over the budget."""
+    if not RESULT_CACHE:
+        return
+    entry = join(RESULT_CACHE_DIR, key)
+    if isdir(entry):
+        os.utime(entry)
+        return
+
+    # Write into a temporary directory first, so that other workers never see a partial entry
+    partial = f"{entry}.{os.getpid()}.part"
+    shutil.rmtree(partial, ignore_errors=True)
+    os.makedirs(partial)
+    try:
+        with open(join(partial, SEGMENTS_FILE), "w", encoding="utf-8") as f:
+            json.dump(segments, f, default=float)
+        with open(join(partial, SRT_FILE), "w", encoding="utf-8") as f:
+            f.write(srt)
+        if preview_file is not None and isfile(preview_file):
+            link_or_copy(preview_file, join(partial, PREVIEW_FILE))
+        os.rename(partial, entry)
+    except OSError:
+        logger.exception("Could not add result to the cache")
+        shutil.rmtree(partial, ignore_errors=True)
+        return
+    evict()
+
+
+def link_or_copy(source, destination):
+    """Hard link a file to save disk space, copy it if the filesystem does not support it."""
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def evict(budget_mb=RESULT_CACHE_MB):
+    entries = []
+    for name in os.listdir(RESULT_CACHE_DIR):
+        entry = join(RESULT_CACHE_DIR, name)
+        if name.endswith(".part") or not isdir(entry):
+            continue
+        try:
+            size = sum(os.path.getsize(join(entry, f)) for f in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, entry))
+        except OSError:
+            continue
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= budget_mb * 1024 * 1024:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+        logger.info(f"Removed {entry} from the result cache")
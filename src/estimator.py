@@ -0,0 +1,135 @@
+import os
+import time
+import socket
+import logging
+import threading
+
+from dotenv import load_dotenv
+
+from src import jobs
+
+load_dotenv()
+
+DEVICE = os.getenv("DEVICE")
+ONLINE = os.getenv("ONLINE") == "True"
+HOST = socket.gethostname()
+# Number of recent jobs per host, device and stage the regression is fitted on
+ESTIMATOR_WINDOW = int(os.getenv("ESTIMATOR_WINDOW", "50"))
+# Number of jobs needed before the regression replaces the fixed estimate
+ESTIMATOR_MIN_JOBS = int(os.getenv("ESTIMATOR_MIN_JOBS", "3"))
+# Seconds a fitted model is reused before it is fitted again on the latest timings
+REFIT_INTERVAL = 60
+
+# Stages of the worker with their share of the run time, used until timings are recorded
+STAGES = {"ingest": 0.1, "asr": 0.55, "align": 0.15, "diarize": 0.15, "render": 0.05}
+
+logger = logging.getLogger(__name__)
+
+_models = {}
+_lock = threading.Lock()
+
+
+def fixed_estimate(duration, online=ONLINE):
+    """Estimate the processing time of a recording with the given length in seconds from fixed ratios."""
+    if online:
+        if DEVICE == "mps":
+            return duration / 5
+        else:
+            return duration / 10
+    else:
+        if DEVICE == "mps":
+            return duration / 3
+        else:
+            return duration / 6
+
+
+def fit(samples):
+    """Fit run time = intercept + slope * duration by least squares. Return None if there are too few samples."""
+    n = len(samples)
+    if n < ESTIMATOR_MIN_JOBS:
+        return None
+    mean_x = sum(x for x, _ in samples) / n
+    mean_y = sum(y for _, y in samples) / n
+    variance = sum((x - mean_x) ** 2 for x, _ in samples)
+    if variance < 1e-9:
+        # All recordings had the same length, fall back to a ratio
+        return 0.0, mean_y / mean_x if mean_x > 0 else 0.0
+    slope = sum((x - mean_x) * (y - mean_y) for x, y in samples) / variance
+    return mean_y - slope * mean_x, slope
+
+
+def get_model(stage, host=None, device=DEVICE):
+    """Return the fitted (intercept, slope) of a stage on a host, or of all hosts if host is None."""
+    key = (stage, host, device)
+    now = time.time()
+    with _lock:
+        if key in _models and now - _models[key][0] < REFIT_INTERVAL:
+            return _models[key][1]
+
+    query = "SELECT duration, seconds FROM timings WHERE stage = ? AND device IS ?"
+    parameters = [stage, device]
+    if host is not None:
+        query += " AND host = ?"
+        parameters.append(host)
+    query += " AND duration > 0 ORDER BY created DESC LIMIT ?"
+    parameters.append(ESTIMATOR_WINDOW)
+    samples = [(row["duration"], row["seconds"]) for row in jobs.get_connection().execute(query, parameters)]
+
+    model = fit(samples)
+    with _lock:
+        _models[key] = (now, model)
+    return model
+
+
+def estimate_stages(duration, host=None, device=DEVICE):
+    """Return the estimated seconds of each stage for a recording with the given length.
+
+    Stages without enough recorded jobs on the host use the recorded jobs of all hosts, and without
+    those their share of the fixed estimate.
+    """
+    estimates = {}
+    for stage, share in STAGES.items():
+        model = get_model(stage, host, device) if host is not None else None
+        if model is None:
+            model = get_model(stage, None, device)
+        if model is None:
+            estimates[stage] = share * fixed_estimate(duration)
+        else:
+            intercept, slope = model
+            estimates[stage] = max(0.0, intercept + slope * duration)
+    return estimates
+
+
+def estimate(duration, host=None, device=DEVICE):
+    """Return the estimated processing time of a recording with the given length in seconds."""
+    return sum(estimate_stages(duration, host, device).values())
+
+
+def record(job_id, duration, timings, predicted=None, speakers=None, language=None, host=HOST, device=DEVICE):
+    """Record the run time of each stage of a finished job, and of the whole job with its estimate."""
+    now = time.time()
+    rows = [(stage, seconds, (predicted or {}).get(stage)) for stage, seconds in timings.items()]
+    rows.append(("total", sum(timings.values()), sum(predicted.values()) if predicted else None))
+    conn = jobs.get_connection()
+    conn.executemany(
+        """INSERT INTO timings (job_id, host, device, stage, duration, speakers, language, seconds, predicted, created)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        [(job_id, host, device, stage, duration, speakers, language, seconds, p, now) for stage, seconds, p in rows],
+    )
+    with _lock:
+        _models.clear()
+
+
+def error_stats(host=None, device=DEVICE, window=ESTIMATOR_WINDOW):
+    """Return the number of recent jobs with an estimate and the mean absolute relative error of the estimates."""
+    query = "SELECT seconds, predicted FROM timings WHERE stage = 'total' AND predicted IS NOT NULL AND device IS ?"
+    parameters = [device]
+    if host is not None:
+        query += " AND host = ?"
+        parameters.append(host)
+    query += " ORDER BY created DESC LIMIT ?"
+    parameters.append(window)
+    rows = [row for row in jobs.get_connection().execute(query, parameters) if row["seconds"] > 0]
+    if not rows:
+        return 0, None
+    return len(rows), sum(abs(row["predicted"] - row["seconds"]) / row["seconds"] for row in rows) / len(rows)
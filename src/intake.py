@@ -0,0 +1,190 @@
+import os
+import time
+import logging
+import threading
+
+from os.path import join, isfile, normpath, basename, dirname
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:  # watchdog is optional, we fall back to periodic scans
+    Observer = None
+    FileSystemEventHandler = object
+
+logger = logging.getLogger(__name__)
+
+IGNORED_FILES = {"hotwords.txt", "language.txt"}
+RECONCILE_INTERVAL = int(os.getenv("INTAKE_RECONCILE_INTERVAL", "60"))
+POLL_INTERVAL = int(os.getenv("INTAKE_POLL_INTERVAL", "2"))
+
+
+class _IntakeHandler(FileSystemEventHandler):
+    def __init__(self, intake):
+        self.intake = intake
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self.intake.notify(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.intake.notify(event.src_path)
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self.intake.forget(event.src_path)
+            self.intake.notify(event.dest_path)
+
+    def on_deleted(self, event):
+        if not event.is_directory:
+            self.intake.forget(event.src_path)
+
+
+class JobIntake:
+    """Keep an in-memory queue of files waiting in data/in and of summaries requested in data/out.
+
+    Changes are picked up from filesystem events (inotify on Linux) if watchdog is installed. A full
+    reconcile scan runs every RECONCILE_INTERVAL seconds to catch events that got lost (e.g. on NFS),
+    or every POLL_INTERVAL seconds if no watcher is available.
+    """
+
+    def __init__(self, root):
+        self.in_dir = normpath(join(root, "data", "in"))
+        self.out_dir = normpath(join(root, "data", "out"))
+        self.lock = threading.Lock()
+        self.files = {}
+        self.summaries = {}
+        self.observer = None
+        self.last_reconcile = 0.0
+
+    def start(self):
+        if Observer is not None:
+            try:
+                self.observer = Observer()
+                handler = _IntakeHandler(self)
+                self.observer.schedule(handler, self.in_dir, recursive=True)
+                self.observer.schedule(handler, self.out_dir, recursive=True)
+                self.observer.daemon = True
+                self.observer.start()
+            except Exception:
+                logger.exception("Could not start file watcher, falling back to periodic scans")
+                self.observer = None
+        else:
+            logger.info("watchdog is not installed, falling back to periodic scans")
+        self.reconcile()
+
+    def stop(self):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+
+    def _classify(self, path):
+        """Return "in", "done" or "summary" if the path is relevant for the worker, otherwise None."""
+        path = normpath(path)
+        parent = dirname(path)
+        if dirname(parent) == self.in_dir and basename(path) not in IGNORED_FILES:
+            return "in"
+        if dirname(parent) == self.out_dir:
+            if path.endswith(".todosummary"):
+                return "summary"
+            if path.endswith(".html"):
+                return "done"
+        return None
+
+    def notify(self, path):
+        kind = self._classify(path)
+        if kind is None:
+            return
+        path = normpath(path)
+        if kind == "done":
+            # A finished transcript removes the input file from the queue
+            self.forget(join(self.in_dir, basename(dirname(path)), basename(path)[: -len(".html")]))
+            return
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            self.forget(path)
+            return
+        if kind == "in":
+            file = basename(path)
+            user_id = basename(dirname(path))
+            if isfile(join(self.out_dir, user_id, file + ".html")):
+                return
+            with self.lock:
+                self.files[path] = mtime
+        else:
+            with self.lock:
+                self.summaries[path] = mtime
+
+    def forget(self, path):
+        path = normpath(path)
+        with self.lock:
+            self.files.pop(path, None)
+            self.summaries.pop(path, None)
+
+    def reconcile(self):
+        """Rebuild the queues with a full scan of data/in and data/out."""
+        files = {}
+        summaries = {}
+        for user_entry in _scandir(self.in_dir):
+            if not user_entry.is_dir():
+                continue
+            done = set(_listdir(join(self.out_dir, user_entry.name)))
+            for entry in _scandir(user_entry.path):
+                if entry.name in IGNORED_FILES or entry.name + ".html" in done or not entry.is_file():
+                    continue
+                try:
+                    files[normpath(entry.path)] = entry.stat().st_mtime
+                except OSError:
+                    continue
+        for user_entry in _scandir(self.out_dir):
+            if not user_entry.is_dir():
+                continue
+            for entry in _scandir(user_entry.path):
+                if entry.name.endswith(".todosummary"):
+                    try:
+                        summaries[normpath(entry.path)] = entry.stat().st_mtime
+                    except OSError:
+                        continue
+        with self.lock:
+            self.files = files
+            self.summaries = summaries
+        self.last_reconcile = time.time()
+
+    def poll(self):
+        """Run a reconcile scan if it is due. Call this once per worker tick."""
+        interval = RECONCILE_INTERVAL if self.observer is not None else POLL_INTERVAL
+        if time.time() - self.last_reconcile >= interval:
+            self.reconcile()
+
+    def pending(self):
+        """Return the queued input files, oldest first."""
+        with self.lock:
+            return [path for path, _ in sorted(self.files.items(), key=lambda x: (x[1], x[0]))]
+
+    def drain(self):
+        """Return the queued input files, oldest first, and empty the queue."""
+        with self.lock:
+            files = self.files
+            self.files = {}
+        return [path for path, _ in sorted(files.items(), key=lambda x: (x[1], x[0]))]
+
+    def pending_summaries(self):
+        """Return the requested summaries, oldest first."""
+        with self.lock:
+            return [path for path, _ in sorted(self.summaries.items(), key=lambda x: (x[1], x[0]))]
+
+
+def _scandir(path):
+    try:
+        return list(os.scandir(path))
+    except OSError:
+        return []
+
+
+def _listdir(path):
+    try:
+        return os.listdir(path)
+    except OSError:
+        return []
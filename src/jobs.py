@@ -0,0 +1,397 @@
+import os
+import time
+import shutil
+import sqlite3
+import logging
+import threading
+
+from os.path import join, isfile
+from dotenv import load_dotenv
+
+from src import scheduler
+
+load_dotenv()
+
+ROOT = os.getenv("ROOT")
+JOBS_DB = os.getenv("JOBS_DB") or join(ROOT, "data", "jobs.db")
+LEASE_TIME = int(os.getenv("LEASE_TIME", "120"))
+MAX_ATTEMPTS = int(os.getenv("MAX_ATTEMPTS", "3"))
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+PROCESSING = "processing"
+DONE = "done"
+ERROR = "error"
+
+# States of the summary of a job. The worker writes it, the web app makes it available for download.
+SUMMARY_WRITTEN = "written"
+SUMMARY_READY = "ready"
+
+# Error message of jobs whose worker crashed MAX_ATTEMPTS times
+FAILED_MESSAGE = "Transkription fehlgeschlagen"
+
+# Columns of the job table. New columns are added to existing databases on startup.
+COLUMNS = {
+    "id": "INTEGER PRIMARY KEY AUTOINCREMENT",
+    "user_id": "TEXT NOT NULL",
+    "file_name": "TEXT NOT NULL",
+    "status": "TEXT NOT NULL",
+    "language": "TEXT",
+    "hotwords": "TEXT",
+    "content_hash": "TEXT",
+    "duration": "REAL",
+    "estimated_time": "REAL",
+    "created": "REAL",
+    "started": "REAL",
+    "finished": "REAL",
+    "error_message": "TEXT",
+    "worker_id": "TEXT",
+    "lease_expires": "REAL",
+    "attempts": "INTEGER NOT NULL DEFAULT 0",
+    "stage": "TEXT",
+    "progress": "REAL",
+    "summary": "TEXT",
+}
+
+IGNORED_FILES = {"hotwords.txt", "language.txt"}
+
+_local = threading.local()
+_init_lock = threading.Lock()
+_initialized = False
+
+
+def get_connection():
+    """Return the connection of the current thread. SQLite connections must not be shared between threads."""
+    global _initialized
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        os.makedirs(os.path.dirname(os.path.abspath(JOBS_DB)), exist_ok=True)
+        conn = sqlite3.connect(JOBS_DB, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _local.conn = conn
+        with _init_lock:
+            if not _initialized:
+                init_db(conn)
+                _initialized = True
+    return conn
+
+
+def init_db(conn):
+    columns = ",\n    ".join(f"{name} {definition}" for name, definition in COLUMNS.items())
+    conn.execute(f"CREATE TABLE IF NOT EXISTS jobs (\n    {columns}\n)")
+    existing = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+    for name, definition in COLUMNS.items():
+        if name not in existing:
+            conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {definition}")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS jobs_user_file ON jobs (user_id, file_name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_summary ON jobs (summary)")
+    # Version of the job table, every change of a job increases it, see get_version()
+    conn.execute("CREATE TABLE IF NOT EXISTS changes (id INTEGER PRIMARY KEY CHECK (id = 0), version INTEGER NOT NULL)")
+    conn.execute("INSERT OR IGNORE INTO changes (id, version) VALUES (0, 0)")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        conn.execute(
+            f"""CREATE TRIGGER IF NOT EXISTS jobs_{event.lower()} AFTER {event} ON jobs
+BEGIN
+    UPDATE changes SET version = version + 1 WHERE id = 0;
+END"""
+        )
+    # Run time of each stage of finished jobs, see src/estimator.py
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS timings (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id INTEGER,
+    host TEXT,
+    device TEXT,
+    stage TEXT NOT NULL,
+    duration REAL,
+    speakers INTEGER,
+    language TEXT,
+    seconds REAL NOT NULL,
+    predicted REAL,
+    created REAL
+)"""
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS timings_stage ON timings (stage, device, host, created)")
+    # ffprobe results of uploaded files, see src/media.py
+    conn.execute(
+        """CREATE TABLE IF NOT EXISTS media (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    duration REAL,
+    has_audio INTEGER,
+    has_video INTEGER,
+    created REAL
+)"""
+    )
+
+
+def register_job(user_id, file_name, language=None, hotwords=None, content_hash=None, created=None):
+    """Queue a new upload. A job with the same name is reset, e.g. after a failed transcription.
+
+    A job that is being processed is left alone, its worker keeps its lease.
+    """
+    get_connection().execute(
+        """INSERT INTO jobs (user_id, file_name, status, language, hotwords, content_hash, created)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, file_name) DO UPDATE SET
+            status = excluded.status,
+            language = excluded.language,
+            hotwords = excluded.hotwords,
+            content_hash = excluded.content_hash,
+            created = excluded.created,
+            duration = NULL,
+            estimated_time = NULL,
+            started = NULL,
+            finished = NULL,
+            error_message = NULL,
+            worker_id = NULL,
+            lease_expires = NULL,
+            attempts = 0,
+            stage = NULL,
+            progress = NULL
+        WHERE jobs.status != ?""",
+        (user_id, file_name, QUEUED, language, hotwords, content_hash, created or time.time(), PROCESSING),
+    )
+
+
+def ensure_job(user_id, file_name, status=QUEUED, created=None, error_message=None):
+    """Add a job that was found on disk but is not known yet. Existing jobs are not changed."""
+    get_connection().execute(
+        """INSERT OR IGNORE INTO jobs (user_id, file_name, status, created, error_message)
+        VALUES (?, ?, ?, ?, ?)""",
+        (user_id, file_name, status, created or time.time(), error_message),
+    )
+
+
+def get_job(user_id, file_name):
+    return get_connection().execute(
+        "SELECT * FROM jobs WHERE user_id = ? AND file_name = ?", (user_id, file_name)
+    ).fetchone()
+
+
+def get_jobs(user_id, status=None):
+    if status is None:
+        return get_connection().execute("SELECT * FROM jobs WHERE user_id = ?", (user_id,)).fetchall()
+    return get_connection().execute(
+        "SELECT * FROM jobs WHERE user_id = ? AND status = ?", (user_id, status)
+    ).fetchall()
+
+
+def get_version():
+    """Return the version of the job table. It changes with every change of a job, in any process."""
+    return get_connection().execute("SELECT version FROM changes WHERE id = 0").fetchone()["version"]
+
+
+def get_queue():
+    """Return all jobs that are not finished yet, across all users, oldest first."""
+    return get_connection().execute(
+        "SELECT * FROM jobs WHERE status IN (?, ?) ORDER BY created", (QUEUED, PROCESSING)
+    ).fetchall()
+
+
+def get_unestimated():
+    """Return the queued jobs without run time estimate."""
+    return get_connection().execute(
+        "SELECT * FROM jobs WHERE status = ? AND estimated_time IS NULL", (QUEUED,)
+    ).fetchall()
+
+
+def set_estimate(user_id, file_name, estimated_time, duration=None):
+    get_connection().execute(
+        "UPDATE jobs SET estimated_time = ?, duration = COALESCE(?, duration) WHERE user_id = ? AND file_name = ?",
+        (estimated_time, duration, user_id, file_name),
+    )
+
+
+def clear_estimates():
+    """Let the queued jobs be estimated again, e.g. after the estimator learned from a finished job."""
+    get_connection().execute("UPDATE jobs SET estimated_time = NULL WHERE status = ?", (QUEUED,))
+
+
+def start_job(user_id, file_name, estimated_time, duration=None):
+    get_connection().execute(
+        """UPDATE jobs SET status = ?, started = ?, estimated_time = ?, duration = COALESCE(?, duration)
+        WHERE user_id = ? AND file_name = ?""",
+        (PROCESSING, time.time(), estimated_time, duration, user_id, file_name),
+    )
+
+
+def claim_job(worker_id, lease_time=LEASE_TIME):
+    """Atomically lease the next queued job in the order of the scheduler to a worker and return it, or None.
+
+    Jobs whose lease has expired (the worker crashed or lost its connection) are put back into the
+    queue first, or marked as failed after MAX_ATTEMPTS tries.
+    """
+    conn = get_connection()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        failed = conn.execute(
+            """SELECT user_id, file_name FROM jobs
+            WHERE status = ? AND COALESCE(lease_expires, 0) < ? AND attempts >= ?""",
+            (PROCESSING, now, MAX_ATTEMPTS),
+        ).fetchall()
+        conn.execute(
+            """UPDATE jobs SET status = ?, finished = ?, error_message = ?, worker_id = NULL
+            WHERE status = ? AND COALESCE(lease_expires, 0) < ? AND attempts >= ?""",
+            (ERROR, now, FAILED_MESSAGE, PROCESSING, now, MAX_ATTEMPTS),
+        )
+        conn.execute(
+            "UPDATE jobs SET status = ?, worker_id = NULL WHERE status = ? AND COALESCE(lease_expires, 0) < ?",
+            (QUEUED, PROCESSING, now),
+        )
+        queue = conn.execute("SELECT * FROM jobs WHERE status IN (?, ?)", (QUEUED, PROCESSING)).fetchall()
+        ordered = scheduler.order_queue(queue)
+        job = ordered[0] if ordered else None
+        if job is not None:
+            conn.execute(
+                """UPDATE jobs SET status = ?, worker_id = ?, lease_expires = ?, started = ?, attempts = attempts + 1,
+                stage = NULL, progress = NULL WHERE id = ?""",
+                (PROCESSING, worker_id, now + lease_time, now, job["id"]),
+            )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    for row in failed:
+        move_to_error(row["user_id"], row["file_name"], FAILED_MESSAGE)
+    return job
+
+
+def move_to_error(user_id, file_name, text):
+    """Move an upload to data/error and write the error text next to it, like the worker does for failed jobs."""
+    file_in = join(ROOT, "data", "in", user_id, file_name)
+    error_dir = join(ROOT, "data", "error", user_id)
+    try:
+        os.makedirs(error_dir, exist_ok=True)
+        with open(join(error_dir, file_name + ".txt"), "w") as f:
+            f.write(text)
+        if isfile(file_in):
+            shutil.move(file_in, join(error_dir, file_name))
+    except OSError:
+        logger.exception(f"Could not move {file_in} to the error directory")
+
+
+def set_progress(job_id, stage, progress):
+    """Publish the stage a job is in and its overall progress between 0 and 1."""
+    get_connection().execute("UPDATE jobs SET stage = ?, progress = ? WHERE id = ?", (stage, progress, job_id))
+
+
+def renew_leases(worker_id, job_ids, lease_time=LEASE_TIME):
+    if not job_ids:
+        return
+    placeholders = ", ".join("?" * len(job_ids))
+    get_connection().execute(
+        f"UPDATE jobs SET lease_expires = ? WHERE worker_id = ? AND status = ? AND id IN ({placeholders})",
+        (time.time() + lease_time, worker_id, PROCESSING, *job_ids),
+    )
+
+
+class LeaseKeeper(threading.Thread):
+    """Background thread that renews the leases of the jobs a worker is processing."""
+
+    def __init__(self, worker_id, lease_time=LEASE_TIME):
+        super().__init__(daemon=True)
+        self.worker_id = worker_id
+        self.lease_time = lease_time
+        self.job_ids = set()
+        self.lock = threading.Lock()
+
+    def hold(self, job_id):
+        with self.lock:
+            self.job_ids.add(job_id)
+
+    def release(self, job_id):
+        with self.lock:
+            self.job_ids.discard(job_id)
+
+    def run(self):
+        while True:
+            time.sleep(self.lease_time / 4)
+            with self.lock:
+                job_ids = list(self.job_ids)
+            try:
+                renew_leases(self.worker_id, job_ids, self.lease_time)
+            except Exception:
+                logger.exception("Could not renew job leases")
+
+
+def release_job(job_id):
+    """Put a leased job back into the queue. The attempt is not counted."""
+    get_connection().execute(
+        """UPDATE jobs SET status = ?, worker_id = NULL, lease_expires = NULL, attempts = MAX(attempts - 1, 0)
+        WHERE id = ? AND status = ?""",
+        (QUEUED, job_id, PROCESSING),
+    )
+
+
+def finish_job(user_id, file_name):
+    get_connection().execute(
+        """UPDATE jobs SET status = ?, finished = ?, worker_id = NULL, stage = NULL, progress = 1
+        WHERE user_id = ? AND file_name = ?""",
+        (DONE, time.time(), user_id, file_name),
+    )
+
+
+def set_summary(user_id, file_name, summary):
+    get_connection().execute(
+        "UPDATE jobs SET summary = ? WHERE user_id = ? AND file_name = ?", (summary, user_id, file_name)
+    )
+
+
+def get_written_summaries():
+    """Return the jobs of all users whose summary the worker has written, but that are not available yet."""
+    return get_connection().execute(
+        "SELECT user_id, file_name FROM jobs WHERE summary = ?", (SUMMARY_WRITTEN,)
+    ).fetchall()
+
+
+def fail_job(user_id, file_name, error_message):
+    get_connection().execute(
+        """UPDATE jobs SET status = ?, finished = ?, error_message = ?, worker_id = NULL
+        WHERE user_id = ? AND file_name = ?""",
+        (ERROR, time.time(), error_message, user_id, file_name),
+    )
+
+
+def delete_job(user_id, file_name):
+    get_connection().execute("DELETE FROM jobs WHERE user_id = ? AND file_name = ?", (user_id, file_name))
+
+
+def import_existing(root):
+    """Register files of an existing data directory that are not in the job table yet."""
+    in_dir = join(root, "data", "in")
+    out_dir = join(root, "data", "out")
+    error_dir = join(root, "data", "error")
+
+    for user_id in _listdir(in_dir):
+        done = set(_listdir(join(out_dir, user_id)))
+        for file_name in _listdir(join(in_dir, user_id)):
+            path = join(in_dir, user_id, file_name)
+            if file_name in IGNORED_FILES or not isfile(path):
+                continue
+            status = DONE if file_name + ".html" in done else QUEUED
+            ensure_job(user_id, file_name, status=status, created=os.path.getmtime(path))
+
+    for user_id in _listdir(error_dir):
+        for file_name in _listdir(join(error_dir, user_id)):
+            path = join(error_dir, user_id, file_name)
+            if file_name.endswith(".txt") or not isfile(path):
+                continue
+            error_message = None
+            if isfile(path + ".txt"):
+                with open(path + ".txt", "r") as f:
+                    error_message = f.read() or None
+            ensure_job(user_id, file_name, status=ERROR, created=os.path.getmtime(path), error_message=error_message)
+
+
+def _listdir(path):
+    try:
+        return os.listdir(path)
+    except OSError:
+        return []
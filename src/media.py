@@ -0,0 +1,60 @@
+import os
+import time
+
+from os.path import abspath, relpath
+from dotenv import load_dotenv
+
+from src import jobs
+from src.util import probe as run_probe
+
+load_dotenv()
+
+ROOT = os.getenv("ROOT")
+
+
+def media_path(file_name):
+    """Return the path of a file relative to ROOT, so that the web host and the workers share the entries."""
+    return relpath(abspath(file_name), abspath(ROOT)) if ROOT else abspath(file_name)
+
+
+def probe(file_name):
+    """Return the duration and the stream types of a media file, running ffprobe only once per file version.
+
+    Results are kept in the job index keyed by path, size and modification time, so a file that is replaced
+    is probed again. Files ffprobe cannot read are remembered with a NaN duration.
+    """
+    stat = os.stat(file_name)
+    path = media_path(file_name)
+    conn = jobs.get_connection()
+    row = conn.execute(
+        "SELECT duration, has_audio, has_video FROM media WHERE path = ? AND size = ? AND mtime_ns = ?",
+        (path, stat.st_size, stat.st_mtime_ns),
+    ).fetchone()
+    if row is not None:
+        return {
+            # SQLite stores NaN as NULL
+            "duration": float("nan") if row["duration"] is None else row["duration"],
+            "has_audio": bool(row["has_audio"]),
+            "has_video": bool(row["has_video"]),
+        }
+
+    media = run_probe(file_name)
+    conn.execute(
+        """INSERT OR REPLACE INTO media (path, size, mtime_ns, duration, has_audio, has_video, created)
+        VALUES (?, ?, ?, ?, ?, ?, ?)""",
+        (
+            path,
+            stat.st_size,
+            stat.st_mtime_ns,
+            media["duration"],
+            media["has_audio"],
+            media["has_video"],
+            time.time(),
+        ),
+    )
+    return media
+
+
+def forget(file_name):
+    """Remove the cached probe of a deleted file."""
+    jobs.get_connection().execute("DELETE FROM media WHERE path = ?", (media_path(file_name),))
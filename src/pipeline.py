@@ -0,0 +1,91 @@
+import queue
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class JobError(Exception):
+    """A job failed with a message that is shown to the user."""
+
+
+class StagePipeline:
+    """Run jobs through a sequence of stages, each with its own threads and a bounded input queue.
+
+    stages is a list of (name, function, threads). Every function takes the job context and returns
+    it for the next stage. Jobs that raise an exception are passed to on_error(context, stage, exception),
+    finished jobs to on_done(context). At most max_jobs jobs are in the pipeline at the same time, so a
+    worker only leases as many jobs as it can work on.
+    """
+
+    def __init__(self, stages, max_jobs=2, queue_size=1, on_done=None, on_error=None):
+        self.stages = stages
+        self.max_jobs = max_jobs
+        self.on_done = on_done
+        self.on_error = on_error
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        self.threads = []
+        self.lock = threading.Lock()
+        self.jobs = 0
+
+    def start(self):
+        for index, (name, function, threads) in enumerate(self.stages):
+            for i in range(threads):
+                thread = threading.Thread(target=self._run_stage, args=(index,), name=f"{name}-{i}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def full(self):
+        with self.lock:
+            return self.jobs >= self.max_jobs
+
+    def submit(self, context):
+        with self.lock:
+            self.jobs += 1
+        self.queues[0].put(context)
+
+    def run(self, context):
+        """Run a job through all stages in the calling thread."""
+        with self.lock:
+            self.jobs += 1
+        for name, function, _ in self.stages:
+            try:
+                context = function(context)
+            except Exception as e:
+                self._fail(context, name, e)
+                return
+        self._done(context)
+
+    def _run_stage(self, index):
+        name, function, _ = self.stages[index]
+        while True:
+            context = self.queues[index].get()
+            try:
+                context = function(context)
+            except Exception as e:
+                self._fail(context, name, e)
+                continue
+            if index + 1 < len(self.stages):
+                self.queues[index + 1].put(context)
+            else:
+                self._done(context)
+
+    def _done(self, context):
+        with self.lock:
+            self.jobs -= 1
+        if self.on_done is not None:
+            try:
+                self.on_done(context)
+            except Exception:
+                logger.exception("Error finishing job")
+
+    def _fail(self, context, stage, exception):
+        with self.lock:
+            self.jobs -= 1
+        if not isinstance(exception, JobError):
+            logger.exception(f"Stage {stage} failed")
+        if self.on_error is not None:
+            try:
+                self.on_error(context, stage, exception)
+            except Exception:
+                logger.exception("Error reporting failed job")
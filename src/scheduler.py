@@ -0,0 +1,135 @@
+import os
+import time
+import heapq
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# fifo: oldest upload first, round_robin: one job per user in turn,
+# wfq: weighted fair queueing by estimated run time, sjf: shortest estimated job first
+SCHEDULER = os.getenv("SCHEDULER", "round_robin")
+# Job classes in order of priority, e.g. "gui,api" serves uploads from the GUI before API uploads
+PRIORITY_ORDER = [c.strip() for c in os.getenv("PRIORITY_ORDER", "gui,api").split(",") if c.strip()]
+# Weights of the job classes for wfq, e.g. "gui=2,api=1"
+CLASS_WEIGHTS = {
+    c.split("=")[0].strip(): float(c.split("=")[1])
+    for c in os.getenv("CLASS_WEIGHTS", "").split(",")
+    if "=" in c
+}
+# Below this progress, the time left of a job is extrapolated from its estimate instead of its progress
+MIN_PROGRESS = 0.05
+
+
+def job_class(job):
+    return "api" if job["user_id"].startswith("api_") else "gui"
+
+
+def job_estimate(job):
+    return job["estimated_time"] or 0
+
+
+def job_progress(job, now=None):
+    """Return the progress of a job that is being processed, between 0 and 1, and the estimated seconds left.
+
+    The progress published by the worker is used once it is meaningful, before that the elapsed share of
+    the estimated run time.
+    """
+    now = now or time.time()
+    elapsed = now - (job["started"] or now)
+    progress = job["progress"] if "progress" in job.keys() else None
+    if progress is not None and progress >= MIN_PROGRESS:
+        return min(progress, 0.999), max(1, elapsed * (1 - progress) / progress)
+    estimate = max(1, job_estimate(job))
+    return min(0.975, elapsed / estimate), max(1, estimate - elapsed)
+
+
+def remaining_time(job, now=None):
+    """Return the estimated seconds until a job that is being processed is done."""
+    return job_progress(job, now)[1]
+
+
+def order_fifo(queued, processing):
+    return sorted(queued, key=lambda j: (j["created"], j["id"]))
+
+
+def order_sjf(queued, processing):
+    return sorted(queued, key=lambda j: (job_estimate(j), j["created"], j["id"]))
+
+
+def order_round_robin(queued, processing):
+    per_user = {}
+    for job in order_fifo(queued, processing):
+        per_user.setdefault(job["user_id"], []).append(job)
+    # Users that are being served right now take their next turn last
+    busy = {job["user_id"] for job in processing}
+    users = sorted(per_user, key=lambda u: (u in busy, per_user[u][0]["created"]))
+
+    ordered = []
+    for turn in range(max((len(j) for j in per_user.values()), default=0)):
+        ordered += [per_user[u][turn] for u in users if turn < len(per_user[u])]
+    return ordered
+
+
+def order_wfq(queued, processing):
+    # Every user starts with the remaining work of its running jobs. Each queued job finishes at the
+    # virtual time of the previous job of the same user plus its estimated run time divided by its weight.
+    now = time.time()
+    finish = {}
+    for job in processing:
+        finish[job["user_id"]] = finish.get(job["user_id"], 0) + remaining_time(job, now)
+
+    tagged = []
+    for job in order_fifo(queued, processing):
+        weight = CLASS_WEIGHTS.get(job_class(job), 1.0)
+        finish[job["user_id"]] = finish.get(job["user_id"], 0) + max(job_estimate(job), 1) / weight
+        tagged.append((finish[job["user_id"]], job["created"], job["id"], job))
+    return [t[-1] for t in sorted(tagged, key=lambda t: t[:3])]
+
+
+SCHEDULERS = {
+    "fifo": order_fifo,
+    "sjf": order_sjf,
+    "round_robin": order_round_robin,
+    "wfq": order_wfq,
+}
+
+
+def order_queue(queue, scheduler=None):
+    """Return the queued jobs in the order in which the workers will process them.
+
+    queue contains the queued and the processing jobs. Job classes are served by strict priority,
+    within a class the jobs are ordered by the configured scheduler.
+    """
+    order = SCHEDULERS.get(scheduler or SCHEDULER, order_round_robin)
+    queued = [job for job in queue if job["status"] == "queued"]
+    processing = [job for job in queue if job["status"] == "processing"]
+
+    ordered = []
+    classes = PRIORITY_ORDER + sorted({job_class(j) for j in queued} - set(PRIORITY_ORDER))
+    for c in classes:
+        ordered += order([j for j in queued if job_class(j) == c], processing)
+    return ordered
+
+
+def estimate_waits(queue, scheduler=None):
+    """Return the estimated seconds until each queued job is started, keyed by job id.
+
+    The schedule is simulated with one worker per distinct worker that is processing jobs, at least one.
+    The jobs a worker has in its pipeline share its models, so the worker is free once all of them are done.
+    """
+    now = time.time()
+    busy = {}
+    for job in queue:
+        if job["status"] == "processing":
+            worker_id = job["worker_id"] or f"job:{job['id']}"
+            busy[worker_id] = busy.get(worker_id, 0) + remaining_time(job, now)
+    workers = list(busy.values()) or [0]
+    heapq.heapify(workers)
+
+    waits = {}
+    for job in order_queue(queue, scheduler):
+        start = heapq.heappop(workers)
+        waits[job["id"]] = start
+        heapq.heappush(workers, start + job_estimate(job))
+    return waits
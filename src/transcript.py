@@ -0,0 +1,333 @@
+import os
+import json
+import datetime
+
+from os.path import isfile, join
+from html.parser import HTMLParser
+
+from src.srt import create_srt
+
+
+def speaker_name(speaker):
+    """Return the name of a diarization speaker as the editor shows it."""
+    if speaker is None or speaker == "unknown":
+        return "Person unbekannt"
+    return f"Person {str(speaker[-2:]).zfill(2)}"
+
+
+def is_foreign(segment, language):
+    """Return whether the editor marks a segment as foreign language, see src/viewer.py."""
+    if "language" not in segment:
+        return False
+    return not ((language == "de" and segment["language"] in ["de", "en", "nl"]) or language == segment["language"])
+
+
+def display_text(text):
+    """Return the text of a segment as the editor shows it."""
+    return " ".join(text.replace("ß", "ss").split())
+
+
+def timestamp(seconds):
+    return str(datetime.timedelta(seconds=round(seconds, 0)))
+
+
+def spread_words(start, end, text):
+    """Return word timings for a text without them, spreading the words over the segment by their length."""
+    words = text.split()
+    total = sum(len(word) + 1 for word in words) or 1
+    result = []
+    position = 0
+    for word in words:
+        word_start = start + (end - start) * position / total
+        position += len(word) + 1
+        word_end = start + (end - start) * position / total
+        result.append({"word": word, "start": round(word_start, 3), "end": round(word_end, 3)})
+    return result
+
+
+def from_worker(segment, language, segment_id):
+    """Return a segment of the worker with the speaker name and the language flag of the editor.
+
+    segment_id is the position of the segment in the editor, which uses it as the id of its span.
+    """
+    result = {
+        "id": segment_id,
+        "start": segment["start"],
+        "end": segment["end"],
+        "speaker": speaker_name(segment.get("speaker")),
+        "text": segment["text"],
+        "foreign": is_foreign(segment, language),
+        "words": segment.get("words", []),
+    }
+    if "language" in segment:
+        result["language"] = segment["language"]
+    return result
+
+
+def save(file_name, segments):
+    """Write the segments of a transcript to its transcript file, one JSON object per line.
+
+    The file is the canonical form of the transcript. All exports are rendered from it, and saves in the
+    editor are written back to it, matched by the id of each segment. It only appears once it is complete.
+    """
+    partial_file = file_name + ".part"
+    with open(partial_file, "w", encoding="utf-8") as f:
+        for segment in segments:
+            record = dict(segment, start=round(segment["start"], 3), end=round(segment["end"], 3))
+            # Words as [start, end, word], words whisperx could not align have no times
+            record["words"] = [
+                [
+                    round(word["start"], 3) if "start" in word else None,
+                    round(word["end"], 3) if "end" in word else None,
+                    word["word"],
+                ]
+                for word in segment["words"]
+            ]
+            f.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+    os.replace(partial_file, file_name)
+
+
+def load(file_name):
+    """Read the segments of a transcript file. Words have the same form as in the output of whisperx.
+
+    Segments of files written before segments had ids get their position, the id of their span in the editor.
+    """
+    segments = []
+    with open(file_name, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            segment = json.loads(line)
+            segment.setdefault("id", len(segments))
+            words = []
+            for start, end, text in segment["words"]:
+                word = {"word": text}
+                if start is not None:
+                    word["start"] = start
+                if end is not None:
+                    word["end"] = end
+                words.append(word)
+            segment["words"] = words
+            segments.append(segment)
+    return segments
+
+
+def editor_file(out_base):
+    """Return the editor of a result in data/out, the one saved online if there is one, or None."""
+    html_file = out_base + ".html"
+    if isfile(html_file + "update"):
+        return html_file + "update"
+    return html_file if isfile(html_file) else None
+
+
+def load_result(out_base):
+    """Return the segments of a result in data/out, or None if there is no result.
+
+    Results transcribed before transcript files existed are read from their editor, see import_existing().
+    """
+    file_name = out_base + ".jsonl"
+    if isfile(file_name):
+        return load(file_name)
+    html_file = editor_file(out_base)
+    if html_file is None:
+        return None
+    with open(html_file, "r", encoding="utf-8") as f:
+        return parse_editor(f.read())
+
+
+def import_existing(root):
+    """Create the transcript files of results that were transcribed before transcript files existed.
+
+    Run once when the worker starts, so that editor saves and reads of the result do not race to create them.
+    """
+    out_dir = join(root, "data", "out")
+    for user_id in _listdir(out_dir):
+        for file in _listdir(join(out_dir, user_id)):
+            if not file.endswith(".html"):
+                continue
+            out_base = join(out_dir, user_id, file[: -len(".html")])
+            if isfile(out_base + ".jsonl"):
+                continue
+            with open(editor_file(out_base), "r", encoding="utf-8") as f:
+                apply_editor(out_base + ".jsonl", f.read())
+
+
+def _listdir(path):
+    try:
+        return os.listdir(path)
+    except OSError:
+        return []
+
+
+class EditorParser(HTMLParser):
+    """Collect the rows of the editor: their speaker, whether they are foreign language and their segments."""
+
+    def __init__(self):
+        super().__init__()
+        self.rows = []
+        # Number of open div elements inside the editor, 0 outside of it
+        self.editor_depth = 0
+        self.in_speaker = False
+        self.segment = None
+        self.span_depth = 0
+
+    def row(self):
+        if not self.rows:
+            self.rows.append({"speaker": "", "foreign": False, "segments": []})
+        return self.rows[-1]
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        classes = (attrs.get("class") or "").split()
+        if not self.editor_depth:
+            if tag == "div" and attrs.get("id") == "editor":
+                self.editor_depth = 1
+            return
+        if tag == "div":
+            self.editor_depth += 1
+        elif tag == "select":
+            self.rows.append({"speaker": "", "foreign": False, "segments": []})
+        elif tag == "option" and "selected" in attrs:
+            self.in_speaker = True
+            self.row()["speaker"] = ""
+        elif tag == "input" and "language" in classes:
+            self.row()["foreign"] = "checked" in attrs
+        elif tag == "span" and self.segment is not None:
+            self.span_depth += 1
+        elif tag == "span" and "segment" in classes:
+            self.segment = {"id": attrs.get("id"), "title": attrs.get("title"), "text": []}
+            self.span_depth = 1
+        elif tag == "br" and self.segment is not None:
+            self.segment["text"].append(" ")
+
+    def handle_endtag(self, tag):
+        if not self.editor_depth:
+            return
+        if tag == "div":
+            self.editor_depth -= 1
+        elif tag == "option":
+            self.in_speaker = False
+        elif tag == "span" and self.segment is not None:
+            self.span_depth -= 1
+            if self.span_depth == 0:
+                self.row()["segments"].append(self.segment)
+                self.segment = None
+
+    def handle_data(self, data):
+        if self.in_speaker:
+            self.row()["speaker"] += data
+        elif self.segment is not None:
+            self.segment["text"].append(data)
+
+
+def parse_title(title):
+    """Return the start and end in seconds of the title of a segment in the editor, e.g. "0:00:02 - 0:00:04"."""
+    try:
+        times = [
+            sum(float(part) * 60**i for i, part in enumerate(reversed(time.strip().split(":"))))
+            for time in title.split(" - ")
+        ]
+    except (AttributeError, ValueError):
+        return None
+    return tuple(times) if len(times) == 2 else None
+
+
+def apply_editor(file_name, html):
+    """Write the transcript as edited in the editor back to the transcript file. Return its segments."""
+    previous = load(file_name) if isfile(file_name) else []
+    segments = parse_editor(html, previous)
+    save(file_name, segments)
+    return segments
+
+
+def parse_editor(html, previous=()):
+    """Return the segments of the transcript as edited in the editor.
+
+    html is the editor or the part of it that the online editor saves. Its spans are matched with the
+    previous segments of the transcript by their id. Segments keep their times and word timings unless their
+    text was changed. Rows added in the editor start where the row before ended and get new ids.
+    """
+    previous = {segment["id"]: segment for segment in previous}
+    parser = EditorParser()
+    parser.feed(html)
+    parser.close()
+
+    spans = [(row, span) for row in parser.rows for span in row["segments"]]
+    span_ids = [int(span["id"]) if span["id"] is not None and span["id"].isdigit() else None for _, span in spans]
+    next_id = max([*previous, *[i for i in span_ids if i is not None]], default=-1) + 1
+    used = set()
+
+    segments = []
+    last_end = 0.0
+    for (row, span), span_id in zip(spans, span_ids):
+        text = " ".join("".join(span["text"]).replace("\xa0", " ").split())
+        if not text:
+            continue
+        if span_id is None or span_id in used:
+            span_id, next_id = next_id, next_id + 1
+        used.add(span_id)
+        original = previous.get(span_id)
+        if original is not None:
+            start, end = original["start"], original["end"]
+        else:
+            start, end = parse_title(span["title"]) or (last_end, last_end)
+
+        segment = {
+            "id": span_id,
+            "start": start,
+            "end": end,
+            "speaker": row["speaker"].strip() or "Person unbekannt",
+        }
+        if original is not None and display_text(original["text"]) == text:
+            segment["text"] = original["text"]
+            segment["words"] = original["words"]
+        else:
+            segment["text"] = text
+            segment["words"] = spread_words(start, end, text)
+        if original is not None and "language" in original:
+            segment["language"] = original["language"]
+        segment["foreign"] = row["foreign"]
+        segments.append(segment)
+        last_end = end
+    return segments
+
+
+def render_text(segments, ignore_foreign=False):
+    """Render the transcript as text, one paragraph per change of speaker, like the export of the editor."""
+    paragraphs = []
+    last_speaker = None
+    for segment in segments:
+        if ignore_foreign and segment["foreign"]:
+            continue
+        if segment["speaker"] != last_speaker:
+            paragraphs.append((f"{segment['speaker']} ({timestamp(segment['start'])})", []))
+            last_speaker = segment["speaker"]
+        paragraphs[-1][1].append(display_text(segment["text"]))
+    return "\n\n".join(f"{header}:\n{' '.join(texts)}" for header, texts in paragraphs)
+
+
+def render_json(segments):
+    """Return the text of the transcript and its segments without word timings and ids."""
+    return {
+        "content": render_text(segments),
+        "segments": [
+            {key: value for key, value in segment.items() if key not in ("words", "id")} for segment in segments
+        ],
+    }
+
+
+def render_srt(segments):
+    return create_srt(segments)
+
+
+def render_vtt(segments):
+    """Render the transcript as WebVTT, the SRT cues with the millisecond separator of WebVTT."""
+    lines = ["WEBVTT", ""]
+    for line in render_srt(segments).split("\n"):
+        lines.append(line.replace(",", ".") if " --> " in line else line)
+    return "\n".join(lines)
+
+
+def summary_input(segments):
+    """Return the transcript in the form the language model summarizes, one line per segment."""
+    return "".join(f"{segment['speaker']}: {display_text(segment['text'])}\n" for segment in segments)
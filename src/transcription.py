@@ -1,13 +1,75 @@
 import os
+import copy
+import json
 import torch
 import pandas as pd
 import time
+import bisect
+import threading
 import whisperx
+from collections import OrderedDict
 from whisperx.audio import SAMPLE_RATE, log_mel_spectrogram, N_SAMPLES
 
 from data.const import data_leaks
+from src.speakers import assign_word_speakers
 
 DEVICE = os.getenv("DEVICE")
+# Memory budget of the alignment models kept in memory, in MB
+ALIGN_CACHE_MB = int(os.getenv("ALIGN_CACHE_MB", "4096"))
+# Alignment models of these languages are never evicted from the cache
+ALIGN_CACHE_PINNED = [l.strip() for l in os.getenv("ALIGN_CACHE_PINNED", "de,en,fr,it").split(",") if l.strip()]
+
+
+class AlignModelCache:
+    """Keep alignment models in memory between jobs, evicting the least recently used ones over the budget."""
+
+    def __init__(self, budget_mb=ALIGN_CACHE_MB, pinned=ALIGN_CACHE_PINNED):
+        self.budget = budget_mb * 1024 * 1024
+        self.pinned = set(pinned)
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, language, device):
+        key = (language, device)
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                self.hits += 1
+                model_a, metadata, _ = self.models[key]
+                return model_a, metadata
+
+            self.misses += 1
+            model_a, metadata = whisperx.load_align_model(language_code=language, device=device)
+            size = sum(t.numel() * t.element_size() for t in list(model_a.parameters()) + list(model_a.buffers()))
+            self.models[key] = (model_a, metadata, size)
+            self._evict(keep=key)
+            return model_a, metadata
+
+    def _evict(self, keep):
+        for key in list(self.models):
+            if self.size() <= self.budget:
+                break
+            if key != keep and key[0] not in self.pinned:
+                del self.models[key]
+
+    def size(self):
+        return sum(size for _, _, size in self.models.values())
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "models": len(self.models), "bytes": self.size()}
+
+
+align_models = AlignModelCache()
+
+# Use the language probabilities of the ASR windows to tag segments, see install_language_capture
+LANGUAGE_FROM_ASR = os.getenv("LANGUAGE_FROM_ASR", "True") == "True"
+LANGUAGE_THRESHOLD = 0.85
+_capture = threading.local()
+_progress = threading.local()
+# Share of the diarization per pyannote step that reports its progress
+DIARIZATION_STEPS = {"segmentation": (0.0, 0.4), "embeddings": (0.4, 0.95)}
 
 
 def get_prompt(self, tokenizer, previous_tokens, without_timestamps, prefix):
@@ -32,40 +94,87 @@ def get_prompt(self, tokenizer, previous_tokens, without_timestamps, prefix):
 
 
 def detect_language(audio, model):
+    return detect_languages([audio], model)[0]
+
+
+def detect_languages(segment_audios, model, batch_size=4):
+    """Detect the language of each audio snippet, running the encoder on batches of snippets."""
     model_n_mels = model.model.feat_kwargs.get("feature_size")
-    segment = log_mel_spectrogram(
-        audio[:N_SAMPLES],
-        n_mels=model_n_mels if model_n_mels is not None else 80,
-        padding=0 if audio.shape[0] >= N_SAMPLES else N_SAMPLES - audio.shape[0],
-    )
-    encoder_output = model.model.encode(segment)
-    results = model.model.model.detect_language(encoder_output)
-    language_token, language_probability = results[0][0]
-    language = language_token[2:-2]
-    return (language, language_probability)
-
-
-def transcribe(
-    complete_name,
-    model,
-    diarize_model,
-    device,
-    num_speaker,
-    add_language=False,
-    hotwords=[],
-    batch_size=4,
-    num_speakers_detected=None,
-    language="de",
-):
-    torch.cuda.empty_cache()
+    results = []
+    for i in range(0, len(segment_audios), batch_size):
+        features = torch.stack(
+            [
+                log_mel_spectrogram(
+                    audio[:N_SAMPLES],
+                    n_mels=model_n_mels if model_n_mels is not None else 80,
+                    padding=0 if audio.shape[0] >= N_SAMPLES else N_SAMPLES - audio.shape[0],
+                )
+                for audio in segment_audios[i : i + batch_size]
+            ]
+        )
+        encoder_output = model.model.encode(features)
+        for result in model.model.model.detect_language(encoder_output):
+            language_token, language_probability = result[0]
+            results.append((language_token[2:-2], language_probability))
+    return results
 
-    # Convert audio given a file path.
-    audio = whisperx.load_audio(complete_name)
 
+def install_language_capture(model):
+    """Let the ASR pass record the language probabilities of every 30 second window it encodes.
+
+    Only calls from a thread inside run_asr() are recorded, so the dedicated language detection,
+    which uses the same encoder, is not affected.
+    """
+    encode = model.model.encode
+
+    def encode_and_detect(features):
+        encoder_output = encode(features)
+        windows = getattr(_capture, "windows", None)
+        if windows is not None:
+            windows += [result[0] for result in model.model.model.detect_language(encoder_output)]
+        return encoder_output
+
+    model.model.encode = encode_and_detect
+
+
+def install_progress_hooks(model):
+    """Let the ASR pass report its progress as the number of encoded VAD chunks out of all chunks.
+
+    whisperx does not report the progress of a transcription, so the merging of the VAD segments into
+    chunks and the encoder are wrapped. Only calls from a thread inside run_asr() with a callback report.
+    """
+    import whisperx.asr
+
+    merge_chunks = whisperx.asr.merge_chunks
+    encode = model.model.encode
+
+    def merge_and_count(*args, **kwargs):
+        chunks = merge_chunks(*args, **kwargs)
+        _progress.total = len(chunks)
+        _progress.done = 0
+        return chunks
+
+    def encode_and_count(features):
+        encoder_output = encode(features)
+        callback = getattr(_progress, "callback", None)
+        if callback is not None and getattr(_progress, "total", 0):
+            _progress.done += features.shape[0]
+            callback(min(1.0, _progress.done / _progress.total))
+        return encoder_output
+
+    whisperx.asr.merge_chunks = merge_and_count
+    model.model.encode = encode_and_count
+
+
+def run_asr(audio, model, hotwords=[], batch_size=4, language="de", complete_name=None, on_progress=None):
+    """Transcribe the audio with Whisper. on_progress(fraction) is called after every batch."""
     start_time = time.time()
 
-    if len(hotwords) > 0:
-        model.options = model.options._replace(prefix=" ".join(hotwords))
+    # The whisperx pipeline keeps the options and the tokenizer of a call on itself. Every call gets its
+    # own copy, so that tracks of the same job can be transcribed concurrently on the shared Whisper model.
+    if DEVICE != "mps":
+        model = copy.copy(model)
+        model.options = model.options._replace(prefix=" ".join(hotwords) if len(hotwords) > 0 else None)
     print("Transcribing...")
     if DEVICE == "mps":
         import mlx_whisper
@@ -73,19 +182,40 @@ def transcribe(
         decode_options = {"language": None, "prefix": " ".join(hotwords)}
 
         result1 = mlx_whisper.transcribe(
-            complete_name,
+            complete_name if complete_name is not None else audio,
             path_or_hf_repo="mlx-community/whisper-large-v3-mlx",
             **decode_options,
         )
     else:
-        result1 = model.transcribe(audio, batch_size=batch_size, language=language)
+        _capture.windows = [] if LANGUAGE_FROM_ASR else None
+        _progress.callback = on_progress
+        _progress.total = 0
+        try:
+            result1 = model.transcribe(audio, batch_size=batch_size, language=language)
+        finally:
+            windows, _capture.windows = _capture.windows, None
+            _progress.callback = None
+        # Every segment of the ASR output is one window of the VAD, in the order they were encoded
+        if windows and len(windows) == len(result1["segments"]):
+            result1["windows"] = [
+                {
+                    "start": segment["start"],
+                    "end": segment["end"],
+                    "language": language_token[2:-2],
+                    "probability": language_probability,
+                }
+                for segment, (language_token, language_probability) in zip(result1["segments"], windows)
+            ]
 
     print(f"Transcription took {time.time() - start_time:.2f} seconds.")
-    if len(hotwords) > 0:
-        model.options = model.options._replace(prefix=None)
+    return result1
+
 
-    # Align whisper output.
-    model_a, metadata = whisperx.load_align_model(language_code=result1["language"], device=device)
+def run_alignment(result1, audio, device):
+    """Align the Whisper output to get word timestamps."""
+    model_a, metadata = align_models.get(result1["language"], device)
+    stats = align_models.stats()
+    print(f"Alignment models: {stats['hits']} hits, {stats['misses']} misses, {stats['bytes'] / 1e6:.0f} MB in memory.")
     start_aligning = time.time()
 
     print("Aligning...")
@@ -99,27 +229,65 @@ def transcribe(
     )
 
     print(f"Alignment took {time.time() - start_aligning:.2f} seconds.")
+    return result2
 
-    if add_language:
-        start_language = time.time()
-        print("Adding language...")
-        for segment in result2["segments"]:
-            start = (int(segment["start"]) * 16_000) - 8_000
-            end = ((int(segment["end"]) + 1) * 16_000) + 8_000
-            segment_audio = audio[start:end]
-            if DEVICE == "mps":
-                ## This is a workaround to use the whisper model in mps, it doesn't have "detect language" method
-                decode_options = {"language": None, "prefix": " ".join(hotwords)}
-                language = mlx_whisper.transcribe(
-                    segment_audio, path_or_hf_repo="mlx-community/whisper-large-v3-mlx", **decode_options
-                )
-                segment["language"] = language["language"]
+
+def window_language(windows, starts, segment):
+    """Return the language of the ASR window containing the middle of the segment, if it is confident."""
+    middle = (segment["start"] + segment["end"]) / 2
+    index = bisect.bisect_right(starts, middle) - 1
+    if index < 0 or middle > windows[index]["end"] or windows[index]["probability"] <= LANGUAGE_THRESHOLD:
+        return None
+    return windows[index]["language"]
+
+
+def add_languages(result2, audio, model, hotwords=[], language="de", batch_size=4, windows=None):
+    """Detect the language of every segment.
+
+    If the language probabilities of the ASR windows are given, segments in a confident window get the
+    language of the window and only the remaining segments are run through the encoder again.
+    """
+    start_language = time.time()
+    print("Adding language...")
+    segments = result2["segments"]
+    if windows and DEVICE != "mps":
+        starts = [window["start"] for window in windows]
+        remaining = []
+        for segment in segments:
+            segment_language = window_language(windows, starts, segment)
+            if segment_language is None:
+                remaining.append(segment)
             else:
-                detected_language, language_probability = detect_language(segment_audio, model)
-                segment["language"] = detected_language if language_probability > 0.85 else language
-        print(f"Adding language took {time.time() - start_language:.2f} seconds.")
+                segment["language"] = segment_language
+        print(f"Language of {len(segments) - len(remaining)} of {len(segments)} segments taken from the ASR windows.")
+        segments = remaining
+
+    segment_audios = []
+    for segment in segments:
+        start = max(0, (int(segment["start"]) * 16_000) - 8_000)
+        end = ((int(segment["end"]) + 1) * 16_000) + 8_000
+        segment_audios.append(audio[start:end])
+
+    if DEVICE == "mps":
+        import mlx_whisper
 
-    # Diarize and assign speaker labels.
+        for segment, segment_audio in zip(segments, segment_audios):
+            ## This is a workaround to use the whisper model in mps, it doesn't have "detect language" method
+            decode_options = {"language": None, "prefix": " ".join(hotwords)}
+            detected = mlx_whisper.transcribe(
+                segment_audio, path_or_hf_repo="mlx-community/whisper-large-v3-mlx", **decode_options
+            )
+            segment["language"] = detected["language"]
+    else:
+        detected = detect_languages(segment_audios, model, batch_size)
+        for segment, (detected_language, language_probability) in zip(segments, detected):
+            segment["language"] = detected_language if language_probability > LANGUAGE_THRESHOLD else language
+    print(f"Adding language took {time.time() - start_language:.2f} seconds.")
+
+
+def run_diarization(audio, diarize_model, num_speaker=None, on_progress=None):
+    """Return the speaker turns of the audio as a data frame. on_progress(fraction) is called by the steps
+    of the pyannote pipeline."""
     start_diarize = time.time()
     print("Diarizing...")
     audio_data = {
@@ -127,27 +295,40 @@ def transcribe(
         "sample_rate": SAMPLE_RATE,
     }
 
-    
-    segments = diarize_model(audio_data, num_speakers=num_speaker)
+    def hook(step_name, step_artifact, file=None, total=None, completed=None):
+        if step_name in DIARIZATION_STEPS and total:
+            start, end = DIARIZATION_STEPS[step_name]
+            on_progress(start + (end - start) * completed / total)
 
-    diarize_df = pd.DataFrame(segments.itertracks(yield_label=True), columns=["segment", "label", "speaker"])
-    diarize_df["start"] = diarize_df["segment"].apply(lambda x: x.start)
-    diarize_df["end"] = diarize_df["segment"].apply(lambda x: x.end)
-    result3 = whisperx.assign_word_speakers(diarize_df, result2)
+    if on_progress is None:
+        segments = diarize_model(audio_data, num_speakers=num_speaker)
+    else:
+        segments = diarize_model(audio_data, num_speakers=num_speaker, hook=hook)
+
+    diarize_df = pd.DataFrame(
+        [(turn.start, turn.end, speaker) for turn, _, speaker in segments.itertracks(yield_label=True)],
+        columns=["start", "end", "speaker"],
+    )
+    print(f"Diarization took {time.time() - start_diarize:.2f} seconds.")
+    return diarize_df
+
+
+def assign_speakers(diarize_df, result2, num_speakers_detected=None):
+    """Assign the speaker labels to the aligned segments and words."""
+    result3 = assign_word_speakers(diarize_df, result2)
     if num_speakers_detected is not None:
         for segment in result3["segments"]:
-            segment["speaker"] = "SPEAKER_" + str(num_speakers_detected + int(segment["speaker"].split('_')[1])).zfill(2)
+            if "speaker" in segment:
+                segment["speaker"] = "SPEAKER_" + str(num_speakers_detected + int(segment["speaker"].split('_')[1])).zfill(2)
+    return result3
 
-    print(f"Diarization took {time.time() - start_diarize:.2f} seconds.")
-    print(f"Total time: {time.time() - start_time:.2f} seconds.")
-    torch.cuda.empty_cache()
-    if DEVICE == "mps":
-        torch.mps.empty_cache()
-    # Text cleanup.
+
+def clean_segments(result3, language):
+    """Remove known hallucinations and empty segments."""
     cleaned_segments = []
     for segment in result3["segments"]:
-        if result1["language"] in data_leaks:
-            for line in data_leaks[result1["language"]]:
+        if language in data_leaks:
+            for line in data_leaks[language]:
                 if line in segment["text"]:
                     segment["text"] = segment["text"].replace(line, "")
         segment["text"] = segment["text"].strip()
@@ -156,3 +337,37 @@ def transcribe(
             cleaned_segments.append(segment)
 
     return cleaned_segments
+
+
+def save_checkpoint(file_name, data):
+    """Save the output of a stage next to the job. The file only appears once it is complete."""
+    with open(file_name + ".part", "w", encoding="utf-8") as f:
+        json.dump(data, f, default=float)
+    os.replace(file_name + ".part", file_name)
+
+
+def load_checkpoint(file_name):
+    """Return the saved output of a stage, or None if the stage has not completed yet."""
+    try:
+        with open(file_name, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_diarization(file_name, diarize_df):
+    save_checkpoint(file_name, diarize_df[["start", "end", "speaker"]].to_dict("records"))
+
+
+def load_diarization(file_name):
+    turns = load_checkpoint(file_name)
+    if turns is None:
+        return None
+    return pd.DataFrame(turns, columns=["start", "end", "speaker"])
+
+
+def empty_cache():
+    torch.cuda.empty_cache()
+    if DEVICE == "mps":
+        torch.mps.empty_cache()
+
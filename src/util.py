@@ -1,70 +1,187 @@
-from pydub import AudioSegment
+import numpy as np
 import subprocess
+import json
 import os
 
 DEVICE = os.getenv("DEVICE")
-      
+# Length of the frames in which the loudest track of a multi-track upload is determined
+ISOLATION_FRAME_MS = 100
+# Gain of a track in the frames in which another track is louder, -100 dB
+ISOLATION_GAIN = 1e-5
+# Number of frames processed at once, to keep the memory bounded for long recordings
+ISOLATION_BLOCK_FRAMES = 600
 
-def isolate_voices(file_paths):
-    for index in range(len(file_paths)):
-        chunk_length_ms = 100
-        chunked = []
-        for file in file_paths:
-            audio = AudioSegment.from_file(file)
-            chunked.append([audio[i : i + chunk_length_ms] for i in range(0, len(audio), chunk_length_ms)])
 
-        processed_chunks = [
-            filter_nondominant_voice([chunks[i] for chunks in chunked], index) for i in range(len(chunked[0]))
-        ]
+def frame_energies(audio, frame_length, block_frames=ISOLATION_BLOCK_FRAMES):
+    """Return the energy of each frame of the audio. The last frame is padded with silence."""
+    n_frames = -(-len(audio) // frame_length)
+    energies = np.zeros(n_frames)
+    block_length = block_frames * frame_length
+    for frame in range(0, n_frames, block_frames):
+        block = np.asarray(audio[frame * frame_length : frame * frame_length + block_length], dtype=np.float64)
+        block = np.pad(block, (0, -len(block) % frame_length))
+        energies[frame : frame + len(block) // frame_length] = np.square(block).reshape(-1, frame_length).sum(axis=1)
+    return energies
 
-        processed_audio = sum(processed_chunks)
-        processed_audio.export(file_paths[index])
 
+def dominated_frames(energies):
+    """Return a boolean matrix with one row per track, true for the frames in which another track is louder.
 
-def filter_nondominant_voice(segments, index):
-    value = segments[index].dBFS
-    for i, segment in enumerate(segments):
-        if i == index:
-            continue
-        if segment.dBFS > value:
-            return segment - 100
-    return segments[index]
+    Tracks of different length count as silent after their end.
+    """
+    n_frames = max((len(e) for e in energies), default=0)
+    matrix = np.zeros((len(energies), n_frames))
+    for index, track_energies in enumerate(energies):
+        matrix[index, : len(track_energies)] = track_energies
+    if len(energies) < 2:
+        return np.zeros(matrix.shape, dtype=bool)
 
+    # The loudest other track is the loudest track, or the second loudest for the loudest track itself
+    order = np.argsort(-matrix, axis=0, kind="stable")
+    loudest = np.take_along_axis(matrix, order[:1], axis=0)[0]
+    second = np.take_along_axis(matrix, order[1:2], axis=0)[0]
+    others = np.where(np.arange(len(energies))[:, None] == order[0], second, loudest)
+    return others > matrix
 
-def get_length(filename):
+
+def write_gated(pcm_file, audio, dominated, frame_length, block_frames=ISOLATION_BLOCK_FRAMES):
+    """Write the audio as raw float32 PCM, attenuated by ISOLATION_GAIN in the dominated frames."""
+    gains = np.where(dominated, ISOLATION_GAIN, 1.0).astype(np.float32)
+    block_length = block_frames * frame_length
+    with open(pcm_file + ".part", "wb") as f:
+        for start in range(0, len(audio), block_length):
+            block = np.asarray(audio[start : start + block_length], dtype=np.float32)
+            first = start // frame_length
+            block = block * np.repeat(gains[first : first + block_frames], frame_length)[: len(block)]
+            f.write(block.tobytes())
+    os.replace(pcm_file + ".part", pcm_file)
+
+
+def isolate_voices(audios, pcm_files, sample_rate=16_000):
+    """Silence every track of a multi-track recording where another track is louder.
+
+    audios is the decoded mono PCM of each track. The loudest track is determined per 100 ms frame from
+    the frame energies, and each track is written once to its PCM file. Return the memory-mapped tracks.
+    """
+    frame_length = sample_rate * ISOLATION_FRAME_MS // 1000
+    dominated = dominated_frames([frame_energies(audio, frame_length) for audio in audios])
+    for pcm_file, audio, track_dominated in zip(pcm_files, audios, dominated):
+        write_gated(pcm_file, audio, track_dominated, frame_length)
+    return [load_pcm(pcm_file) for pcm_file in pcm_files]
+
+
+def probe(filename):
+    """Read the duration and the stream types of a media file with a single ffprobe call."""
     result = subprocess.run(
         [
             "ffprobe",
             "-v",
             "error",
             "-show_entries",
-            "format=duration",
+            "format=duration:stream=codec_type",
             "-of",
-            "default=noprint_wrappers=1:nokey=1",
+            "json",
             filename,
         ],
         stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
+        stderr=subprocess.PIPE,
+    )
+    info = json.loads(result.stdout or b"{}")
+    codec_types = [stream.get("codec_type") for stream in info.get("streams", [])]
+    return {
+        "duration": float(info.get("format", {}).get("duration", "nan")),
+        "has_audio": "audio" in codec_types,
+        "has_video": "video" in codec_types,
+    }
+
+
+def run_ffmpeg(command, duration=None, on_progress=None):
+    """Run an ffmpeg command and return its exit code, passing the processed share of the input to on_progress."""
+    if on_progress is None or not duration:
+        return subprocess.run(command).returncode
+    process = subprocess.Popen(
+        command[:1] + ["-progress", "pipe:1", "-nostats"] + command[1:], stdout=subprocess.PIPE, text=True
+    )
+    for line in process.stdout:
+        key, _, value = line.strip().partition("=")
+        if key == "out_time_us" and value.isdigit():
+            on_progress(min(1.0, int(value) / 1_000_000 / duration))
+    return process.wait()
+
+
+def decode_media(filename, pcm_file, preview_file=None, sample_rate=16_000, duration=None, on_progress=None):
+    """Decode a media file once into raw mono float32 PCM for the models and, optionally, the preview video.
+
+    Both outputs are written by the same ffmpeg process. The PCM file only appears once it is complete.
+    Return the memory-mapped PCM and whether the preview could be created. Raise a RuntimeError if the
+    audio could not be decoded. If the duration of the file is given, on_progress(fraction) is called
+    while decoding.
+    """
+    partial_file = pcm_file + ".part"
+    pcm_output = ["-vn", "-ac", "1", "-ar", str(sample_rate), "-acodec", "pcm_f32le", "-f", "f32le", partial_file]
+    command = ["ffmpeg", "-y", "-nostdin", "-loglevel", "error", "-i", filename] + pcm_output
+
+    preview_created = False
+    if preview_file is not None:
+        for video_options in (["-filter:v", "scale=320:-2"], ["-c:v", "copy"]):
+            preview_output = video_options + ["-af", "lowpass=3000,highpass=200", preview_file]
+            if run_ffmpeg(command + preview_output, duration, on_progress) == 0:
+                preview_created = True
+                break
+    if not preview_created and run_ffmpeg(command, duration, on_progress) != 0:
+        raise RuntimeError(f"Could not decode {filename}")
+    if os.path.getsize(partial_file) == 0:
+        os.remove(partial_file)
+        raise RuntimeError(f"No audio in {filename}")
+    os.replace(partial_file, pcm_file)
+
+    return load_pcm(pcm_file), preview_created
+
+
+def mix_preview(pcm_files, preview_file, sample_rate=16_000):
+    """Mix decoded tracks down into the filtered preview audio for the editor in a single ffmpeg run.
+
+    Mixdown, filter and encoding are one filter graph, so the tracks are read once and nothing is written
+    in between. The preview file only appears once it is complete. Return whether it could be created.
+    """
+    inputs = []
+    for pcm_file in pcm_files:
+        inputs += ["-f", "f32le", "-ar", str(sample_rate), "-ac", "1", "-i", pcm_file]
+    streams = "".join(f"[{i}:a]" for i in range(len(pcm_files)))
+    graph = f"{streams}amix=inputs={len(pcm_files)}:duration=first,lowpass=3000,highpass=200[preview]"
+    partial_file = preview_file + ".part"
+    command = (
+        ["ffmpeg", "-y", "-nostdin", "-loglevel", "error"]
+        + inputs
+        + ["-filter_complex", graph, "-map", "[preview]", "-c:a", "aac", "-f", "mp4", partial_file]
     )
-    return float(result.stdout)
+    if run_ffmpeg(command) != 0:
+        if os.path.exists(partial_file):
+            os.remove(partial_file)
+        return False
+    os.replace(partial_file, preview_file)
+    return True
+
+
+def load_pcm(pcm_file):
+    """Memory-map raw mono float32 PCM, so that the models page the recording in from disk as they read it.
+
+    The map is copy-on-write, so that slices can be passed to torch without touching the file.
+    """
+    return np.memmap(pcm_file, dtype=np.float32, mode="c")
+
 
+def time_estimate(filename):
+    from src import estimator, media
 
-def time_estimate(filename, online=True):
     try:
         # For now, we don't predict the wait time for zipped files in the queue.
         if filename[-4:] == ".zip":
             return 1, 1
-        run_time = get_length(filename)
-        if online:
-            if DEVICE == "mps":
-                return run_time / 5, run_time
-            else:
-                return run_time / 10, run_time
-        else:
-            if DEVICE == "mps":
-                return run_time / 3, run_time
-            else:
-                return run_time / 6, run_time
+        run_time = media.probe(filename)["duration"]
+        if run_time != run_time:  # NaN if ffprobe could not read the file
+            raise ValueError(f"Could not read the length of {filename}")
+        return estimator.estimate(run_time), run_time
     except Exception as e:
         print(e)
         return -1, -1
@@ -581,29 +581,3 @@ def write_content_summary(summary, lines, file_name):
 				</div>''', '')
 	with open(file_name, 'w', encoding = 'utf-8') as f:
 		f.write(lines)
-        
-        
-def read_content_summary(file_name):
-	lines = ''
-	with open(file_name, 'r', encoding = 'utf-8') as f:
-		lines = f.read()
-		
-	content_out = ''
-
-	index = lines.find('selected="selected">')
-	content = lines[index + len('selected="selected">'):]
-	content = content[:content.find('<script language="javascript">')]
-	while index > -1:
-		content_out += content[:content.find('</option>')] + ': '
-		
-		index = content.find('class="segment" title=')
-		if index == -1:
-			break
-		else:
-			content = content[index + len('class="segment" title="0:00:02 - 0:00:04">'):]
-			content_out += content[:content.find('</span>')] + '\n'
-
-		index = content.find('selected="selected">')
-		content = content[index + len('selected="selected">'):]
-	
-	return content_out, lines
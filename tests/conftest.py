@@ -0,0 +1,7 @@
+import os
+import tempfile
+
+# The worker reads its configuration when it is imported
+os.environ.setdefault("ROOT", tempfile.mkdtemp(prefix="transcribo-test-"))
+os.environ.setdefault("BATCH_SIZE", "4")
+os.environ.setdefault("DEVICE", "cpu")
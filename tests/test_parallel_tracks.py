@@ -0,0 +1,61 @@
+import threading
+
+from collections import namedtuple
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("whisperx")
+pytest.importorskip("pyannote.audio")
+pytest.importorskip("pandas")
+
+import worker
+
+Options = namedtuple("Options", ["prefix"])
+
+
+class StatefulPipeline:
+    """Keep the state of a call on the pipeline like the whisperx pipeline does.
+
+    The tokenizer is created at the start of a call and reset at its end. Track "a" ends while track "b"
+    is still decoding.
+    """
+
+    def __init__(self):
+        self.options = Options(prefix=None)
+        self.tokenizer = None
+        self.started = threading.Barrier(2, timeout=10)
+        self.first_done = threading.Event()
+
+    def transcribe(self, audio, batch_size=4, language=None):
+        if self.tokenizer is None:
+            self.tokenizer = language
+        self.started.wait()
+        if audio == "b":
+            assert self.first_done.wait(10)
+        tokenizer, prefix = self.tokenizer, self.options.prefix
+        self.tokenizer = None
+        if audio == "a":
+            self.first_done.set()
+        return {"segments": [], "language": tokenizer, "prefix": prefix}
+
+
+def test_tracks_are_transcribed_concurrently(tmp_path, monkeypatch):
+    model = StatefulPipeline()
+    monkeypatch.setattr(worker, "model", model, raising=False)
+    monkeypatch.setattr(worker, "TRACK_THREADS", 2)
+    monkeypatch.setattr(worker, "report_progress", lambda *args, **kwargs: None)
+    ctx = {
+        "scratch_dir": str(tmp_path),
+        "tracks": [{"audio": "a", "path": "a.wav"}, {"audio": "b", "path": "b.wav"}],
+        "hotwords": ["Zürich"],
+        "language": "de",
+    }
+
+    worker.asr(ctx)
+
+    for track in ctx["tracks"]:
+        assert track["result1"]["language"] == "de"
+        assert track["result1"]["prefix"] == "Zürich"
+    # The shared pipeline is left as it was loaded
+    assert model.options.prefix is None
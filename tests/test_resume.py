@@ -0,0 +1,75 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("whisperx")
+pytest.importorskip("pyannote.audio")
+pd = pytest.importorskip("pandas")
+
+import worker
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """Replace the models of the stages by fakes that count how often they run."""
+    calls = {"asr": 0, "align": 0, "diarize": 0}
+
+    def run_asr(audio, model, hotwords, batch_size, language, path, on_progress=None):
+        calls["asr"] += 1
+        return {"segments": [{"start": 0.0, "end": 1.0, "text": " Hallo"}], "language": "de"}
+
+    def run_alignment(result, audio, device):
+        calls["align"] += 1
+        words = [{"word": "Hallo", "start": 0.1, "end": 0.9}]
+        return {"segments": [{"start": 0.1, "end": 0.9, "text": " Hallo", "words": words}], "word_segments": words}
+
+    def run_diarization(audio, diarize_model, on_progress=None):
+        calls["diarize"] += 1
+        if calls.get("crash"):
+            raise RuntimeError("worker killed")
+        return pd.DataFrame([{"start": 0.0, "end": 1.0, "speaker": "SPEAKER_00"}])
+
+    monkeypatch.setattr(worker, "run_asr", run_asr)
+    monkeypatch.setattr(worker, "run_alignment", run_alignment)
+    monkeypatch.setattr(worker, "run_diarization", run_diarization)
+    monkeypatch.setattr(worker, "assign_speakers", lambda diarize_df, result, offset: result)
+    monkeypatch.setattr(worker, "clean_segments", lambda result, language: result["segments"])
+    monkeypatch.setattr(worker, "report_progress", lambda *args, **kwargs: None)
+    monkeypatch.setattr(worker, "empty_cache", lambda: None)
+    monkeypatch.setattr(worker, "ADD_LANGUAGE", False)
+    monkeypatch.setattr(worker, "model", None, raising=False)
+    monkeypatch.setattr(worker, "diarize_model", None, raising=False)
+    return calls
+
+
+def job_context(scratch_dir):
+    return {
+        "scratch_dir": str(scratch_dir),
+        "tracks": [{"audio": [0.0], "path": "track.wav"}],
+        "hotwords": [],
+        "language": "de",
+        "is_zip": False,
+    }
+
+
+def run_stages(ctx):
+    return worker.diarize(worker.align(worker.asr(ctx)))
+
+
+def test_restarted_job_skips_finished_stages(tmp_path, calls):
+    # The worker dies during the diarization, after transcription and alignment were saved
+    calls["crash"] = True
+    with pytest.raises(RuntimeError):
+        run_stages(job_context(tmp_path))
+    assert (calls["asr"], calls["align"], calls["diarize"]) == (1, 1, 1)
+
+    calls["crash"] = False
+    ctx = run_stages(job_context(tmp_path))
+    assert (calls["asr"], calls["align"], calls["diarize"]) == (1, 1, 2)
+    assert ctx["tracks"][0]["segments"][0]["words"][0]["word"] == "Hallo"
+
+    # A job that completed all stages does not run any model again
+    ctx = run_stages(job_context(tmp_path))
+    assert (calls["asr"], calls["align"], calls["diarize"]) == (1, 1, 2)
+    assert ctx["tracks"][0]["segments"] == [
+        {"start": 0.1, "end": 0.9, "text": " Hallo", "words": [{"word": "Hallo", "start": 0.1, "end": 0.9}]}
+    ]
@@ -0,0 +1,73 @@
+from src import transcript
+
+
+def worker_segment(start, end, text):
+    words = transcript.spread_words(start, end, text)
+    return {"start": start, "end": end, "text": text, "speaker": "SPEAKER_00", "words": words}
+
+
+def editor(spans):
+    """Return the editor with one row of Person 00 holding spans of (id, title, text)."""
+    html = '<div id="editor"><div><div style="display: block;"><select onchange="selectChange(this)">'
+    html += '<option value="00" selected="selected">Person 00</option></select></div><p class="form-control">'
+    for span_id, title, text in spans:
+        span_id = "" if span_id is None else f' id="{span_id}"'
+        html += f'<span{span_id} contenteditable="true" class="segment" title="{title}">{text}</span>\n'
+    return html + "</p></div></div>"
+
+
+def test_saves_match_segments_by_id(tmp_path):
+    file_name = str(tmp_path / "audio.mp3.jsonl")
+    data = [
+        worker_segment(0.0, 2.0, "Hallo zusammen"),
+        worker_segment(2.0, 4.0, "Wie geht es"),
+        worker_segment(4.0, 6.0, "Gut danke"),
+    ]
+    transcript.save(file_name, [transcript.from_worker(segment, "de", i) for i, segment in enumerate(data)])
+
+    # The first row is emptied and a row is added after the second one
+    spans = [
+        ("0", "0:00:00 - 0:00:02", ""),
+        ("1", "0:00:02 - 0:00:04", "Wie geht es"),
+        (None, "0:00:02 - 0:00:04", "Neues Textsegment"),
+        ("2", "0:00:04 - 0:00:06", "Gut danke"),
+    ]
+    first = transcript.apply_editor(file_name, editor(spans))
+    assert [segment["id"] for segment in first] == [1, 3, 2]
+    assert [segment["text"] for segment in first] == ["Wie geht es", "Neues Textsegment", "Gut danke"]
+
+    # The page still has the ids the editor was rendered with
+    spans[3] = ("2", "0:00:04 - 0:00:06", "Sehr gut danke")
+    second = transcript.apply_editor(file_name, editor(spans))
+    assert [(segment["start"], segment["end"]) for segment in second] == [(2.0, 4.0), (2.0, 4.0), (4.0, 6.0)]
+    assert second[0]["words"] == transcript.load(file_name)[0]["words"] == data[1]["words"]
+    assert second[2]["text"] == "Sehr gut danke"
+    assert [word["word"] for word in second[2]["words"]] == ["Sehr", "gut", "danke"]
+    assert len({segment["id"] for segment in second}) == 3
+
+
+def test_files_without_ids_use_positions(tmp_path):
+    file_name = str(tmp_path / "audio.mp3.jsonl")
+    segments = [transcript.from_worker(worker_segment(i, i + 1.0, f"Satz {i}"), "de", i) for i in range(2)]
+    for segment in segments:
+        del segment["id"]
+    transcript.save(file_name, segments)
+
+    assert [segment["id"] for segment in transcript.load(file_name)] == [0, 1]
+
+
+def test_results_without_transcript_file(tmp_path):
+    out_dir = tmp_path / "data" / "out" / "local"
+    out_dir.mkdir(parents=True)
+    (out_dir / "audio.mp3.html").write_text(editor([("0", "0:00:01 - 0:00:03", "Hallo zusammen")]), encoding="utf-8")
+    out_base = str(out_dir / "audio.mp3")
+
+    # Reading the result does not create the transcript file
+    segments = transcript.load_result(out_base)
+    assert [(segment["start"], segment["end"], segment["text"]) for segment in segments] == [
+        (1.0, 3.0, "Hallo zusammen")
+    ]
+    assert not (out_dir / "audio.mp3.jsonl").exists()
+
+    transcript.import_existing(str(tmp_path))
+    assert transcript.load(out_base + ".jsonl") == segments
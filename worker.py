@@ -1,22 +1,44 @@
 import os
 import shutil
 import time
-import fnmatch
 import types
-import ffmpeg
 import torch
 import whisperx
 import zipfile
 import logging
+import socket
+import heapq
+import threading
 
-from os.path import isfile, join, normpath, basename, dirname
+from concurrent.futures import ThreadPoolExecutor
+
+from os.path import isfile, join, normpath, basename, dirname, splitext
 from dotenv import load_dotenv
 from pyannote.audio import Pipeline
+from whisperx.asr import WhisperModel
 
-from src.viewer import create_viewer, write_content_summary, read_content_summary
+from src.viewer import create_viewer, write_content_summary
 from src.srt import create_srt
-from src.transcription import transcribe, get_prompt
-from src.util import time_estimate, isolate_voices
+from src.transcription import (
+    get_prompt,
+    install_language_capture,
+    install_progress_hooks,
+    run_asr,
+    run_alignment,
+    add_languages,
+    run_diarization,
+    assign_speakers,
+    clean_segments,
+    empty_cache,
+    save_checkpoint,
+    load_checkpoint,
+    save_diarization,
+    load_diarization,
+)
+from src.util import time_estimate, isolate_voices, probe, decode_media, load_pcm, mix_preview
+from src.intake import JobIntake
+from src import jobs, cache, estimator, media, transcript
+from src.pipeline import StagePipeline, JobError
 
 # Load environment variables
 load_dotenv()
@@ -28,6 +50,29 @@ ROOT = os.getenv("ROOT")
 WINDOWS = os.getenv("WINDOWS") == "True"
 BATCH_SIZE = int(os.getenv("BATCH_SIZE"))
 SUMMARIZATION = os.getenv("SUMMARIZATION") == "True"
+PIPELINE_DEPTH = int(os.getenv("PIPELINE_DEPTH", "2"))
+INGEST_THREADS = int(os.getenv("INGEST_THREADS", "1"))
+# Seconds after queueing in which a missing upload is still expected to be moved into data/in
+PLACE_TIME = 10
+# Limits of zip uploads, larger uploads fail before they are extracted
+ZIP_MAX_MEMBERS = int(os.getenv("ZIP_MAX_MEMBERS", "32"))
+ZIP_MAX_BYTES = int(os.getenv("ZIP_MAX_MB", "12288")) * 1024 * 1024
+# Number of extracted tracks of a zip file that are decoded at the same time
+ZIP_DECODE_THREADS = int(os.getenv("ZIP_DECODE_THREADS", "2"))
+# Members of zip files with other extensions are skipped
+MEDIA_EXTENSIONS = {
+    ".aac", ".aif", ".aiff", ".amr", ".flac", ".m4a", ".mp2", ".mp3", ".oga", ".ogg", ".opus", ".wav", ".weba",
+    ".wma", ".3gp", ".avi", ".flv", ".m4v", ".mkv", ".mov", ".mp4", ".mpeg", ".mpg", ".mts", ".ts", ".webm", ".wmv",
+}
+# Number of tracks of a zip file that are transcribed and aligned at the same time
+TRACK_THREADS = int(os.getenv("TRACK_THREADS", "2" if DEVICE == "cpu" else "1"))
+# Run the diarization of a job in the background while it is transcribed and aligned
+PARALLEL_DIARIZATION = os.getenv("PARALLEL_DIARIZATION", "False") == "True"
+# CPU threads of the Whisper model and of the torch models (diarization, alignment), 0 keeps the torch default
+ASR_THREADS = int(os.getenv("ASR_THREADS", "4"))
+DIARIZE_THREADS = int(os.getenv("DIARIZE_THREADS", "0"))
+# on MPS is rather slow and unreliable, but you can try with setting this to true
+ADD_LANGUAGE = False if DEVICE == "mps" else True
 
 if SUMMARIZATION:
     from llama_cpp import Llama
@@ -40,6 +85,12 @@ if SUMMARIZATION:
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+diarization_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="diarize") if PARALLEL_DIARIZATION else None
+# The preview of a zip file is mixed down while its tracks are transcribed
+preview_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="preview")
+
 if WINDOWS:
     os.environ["PATH"] += os.pathsep + "ffmpeg/bin"
     os.environ["PATH"] += os.pathsep + "ffmpeg"
@@ -55,142 +106,579 @@ def report_error(file_name, file_name_error, user_id, text=""):
     with open(error_file, "w") as f:
         f.write(text)
     shutil.move(file_name, file_name_error)
+    jobs.fail_job(user_id, basename(file_name), text)
+
+
+def job_options(user_id, file):
+    """Return the language and hotwords of a job. Jobs from older versions keep them in text files."""
+    job = jobs.get_job(user_id, file)
+    language = job["language"] if job else None
+    hotwords = job["hotwords"] if job else None
+
+    if language is None:
+        language_file = join(ROOT, "data", "in", user_id, "language.txt")
+        if isfile(language_file):
+            with open(language_file, "r") as h:
+                language = h.read()
+        else:
+            language = "de"
+    if hotwords is None:
+        hotwords_file = join(ROOT, "data", "in", user_id, "hotwords.txt")
+        if isfile(hotwords_file):
+            with open(hotwords_file, "r") as h:
+                hotwords = h.read()
+    hotwords = hotwords.splitlines() if hotwords else []
+    return language, hotwords
+
+
+def estimate_jobs():
+    """Estimate the run time of new jobs, so that the scheduler and the ETAs can use it."""
+    for job in jobs.get_unestimated():
+        file_name = join(ROOT, "data", "in", job["user_id"], job["file_name"])
+        if not isfile(file_name):
+            continue
+        if job["duration"] is not None:
+            jobs.set_estimate(job["user_id"], job["file_name"], estimator.estimate(job["duration"]))
+            continue
+        estimated_time, run_time = time_estimate(file_name)
+        if estimated_time == -1:
+            estimated_time, run_time = 0, None
+        jobs.set_estimate(job["user_id"], job["file_name"], estimated_time, run_time)
 
 
-def oldest_files(folder):
-    matches = []
-    times = []
-    for root, _, filenames in os.walk(folder):
-        for filename in fnmatch.filter(filenames, "*.*"):
-            file_path = join(root, filename)
-            matches.append(file_path)
-            times.append(os.path.getmtime(file_path))
-    return [m for _, m in sorted(zip(times, matches))]
+def check_audio(file_name, cached=True):
+    """Return the length of a file in seconds and make sure that it has an audio stream.
 
+    Uploads were already probed by the web host. Temporary files pass cached=False to stay out of the cache.
+    """
+    try:
+        info = media.probe(file_name) if cached else probe(file_name)
+    except Exception as e:
+        logger.exception("Error probing file")
+        raise JobError("Datei konnte nicht gelesen werden")
+    if info["duration"] != info["duration"]:  # NaN if ffprobe could not read the file
+        raise JobError("Datei konnte nicht gelesen werden")
+    if not info["has_audio"]:
+        raise JobError("Die Tonspur der Datei konnte nicht gelesen werden")
+    return info["duration"]
+
+
+def estimate_job(ctx, duration):
+    """Estimate the run time of each stage of a job on this host from its length and mark it as started."""
+    ctx["duration"] = duration
+    ctx["stage_estimates"] = estimator.estimate_stages(duration, estimator.HOST)
+    ctx["estimated_time"] = sum(ctx["stage_estimates"].values())
+    jobs.start_job(ctx["user_id"], ctx["file"], ctx["estimated_time"], duration)
+
+
+def report_progress(ctx, stage, fraction=0.0, track=0):
+    """Publish the progress of a job in the job index, at most every few seconds unless the stage changes.
+
+    fraction is the progress of the stage for one track. Tracks may be processed concurrently.
+    """
+    tracks = max(1, len(ctx["tracks"]))
+    # The stages are weighted by their estimated run time on this host
+    weights = ctx["stage_estimates"] or estimator.STAGES
+    total = sum(weights.values()) or 1
+    with ctx["lock"]:
+        fractions = ctx["fractions"].setdefault(stage, {})
+        fractions[track] = fraction
+        progress = 0.0
+        for name, weight in ((name, weight / total) for name, weight in weights.items()):
+            if name == stage:
+                progress += weight * sum(fractions.values()) / tracks
+                break
+            progress += weight
+        progress = max(progress, ctx["progress"][1])
+
+        if stage == ctx["progress"][0] and progress - ctx["progress"][1] < 0.01 and time.time() - ctx["progress"][2] < 5:
+            return
+        ctx["progress"] = (stage, progress, time.time())
+    try:
+        jobs.set_progress(ctx["job"]["id"], stage, round(progress, 3))
+    except Exception:
+        logger.exception("Could not publish the job progress")
 
-def transcribe_file(
-    file_name, multi_mode=False, num_speakers_detected=None, audio_files=None, language="de"
-):
-    data = None
-    estimated_time = 0
-    progress_file_name = ""
 
-    file = basename(file_name)
-    user_id = normpath(dirname(file_name)).split(os.sep)[-1]
-    file_name_error = join(ROOT, "data", "error", user_id, file)
-    file_name_out = join(ROOT, "data", "out", user_id, file + ".mp4")
+def load_audio(file_name, pcm_file, preview_file=None, duration=None, on_progress=None):
+    """Decode the audio for the models and the preview video for the editor in a single ffmpeg run.
 
-    # Clean up worker directory
-    if not multi_mode:
-        worker_user_dir = join(ROOT, "data", "worker", user_id)
-        if os.path.exists(worker_user_dir):
-            try:
-                shutil.rmtree(worker_user_dir)
-            except OSError as e:
-                logger.error(f"Could not remove folder: {worker_user_dir}. Error: {e}")
-
-    # Create output directory
-    if not multi_mode:
-        output_user_dir = join(ROOT, "data", "out", user_id)
-        os.makedirs(output_user_dir, exist_ok=True)
-
-    # Estimate run time
+    The PCM stays in the scratch directory of the job and is memory-mapped by all stages, so a retried
+    job skips decoding.
+    """
+    if isfile(pcm_file):
+        if preview_file is not None and not isfile(preview_file):
+            create_preview(file_name, preview_file)
+        return load_pcm(pcm_file)
     try:
-        time.sleep(2)
-        estimated_time, run_time = time_estimate(file_name, ONLINE)
-        if run_time == -1:
-            report_error(
-                file_name, file_name_error, user_id, "Datei konnte nicht gelesen werden"
-            )
-            return data, estimated_time, progress_file_name
-    except Exception as e:
-        logger.exception("Error estimating run time")
-        report_error(
-            file_name, file_name_error, user_id, "Datei konnte nicht gelesen werden"
+        audio, preview_created = decode_media(
+            file_name, pcm_file, preview_file, duration=duration, on_progress=on_progress
         )
-        return data, estimated_time, progress_file_name
-
-    if not multi_mode:
-        worker_user_dir = join(ROOT, "data", "worker", user_id)
-        os.makedirs(worker_user_dir, exist_ok=True)
-        progress_file_name = join(
-            worker_user_dir, f"{estimated_time}_{int(time.time())}_{file}"
+    except RuntimeError as e:
+        logger.exception("ffmpeg error during audio processing")
+        raise JobError("Die Tonspur der Datei konnte nicht gelesen werden")
+    if preview_file is not None and not preview_created:
+        logger.error("ffmpeg error during preview processing")
+    return audio
+
+
+def create_preview(file_name, file_name_out):
+    """Convert and filter the file for the editor. Return the original file if this fails."""
+    exit_status = os.system(
+        f'ffmpeg -y -i "{file_name}" -filter:v scale=320:-2 -af "lowpass=3000,highpass=200" "{file_name_out}"'
+    )
+    if exit_status == 256:
+        exit_status = os.system(
+            f'ffmpeg -y -i "{file_name}" -c:v copy -af "lowpass=3000,highpass=200" "{file_name_out}"'
         )
-        try:
-            with open(progress_file_name, "w") as f:
-                f.write("")
-        except OSError as e:
-            logger.error(
-                f"Could not create progress file: {progress_file_name}. Error: {e}"
-            )
+    if not exit_status == 0:
+        logger.error("ffmpeg error during audio processing")
+        return file_name  # Fallback to original file
+    return file_name_out
+
+
+def prepare_scratch_dir(scratch_dir, file_name):
+    """Create the scratch directory of a job. Files of an earlier attempt are kept if the upload is unchanged.
+
+    Return whether files of an earlier attempt were kept.
+    """
+    stat = os.stat(file_name)
+    source = f"{stat.st_size}:{stat.st_mtime_ns}"
+    source_file = join(scratch_dir, "source")
+    if isfile(source_file):
+        with open(source_file, "r") as f:
+            if f.read() == source:
+                return True
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+    os.makedirs(scratch_dir, exist_ok=True)
+    with open(source_file, "w") as f:
+        f.write(source)
+    return False
+
+
+def job_context(job):
+    """Return the context that is passed through the pipeline stages, or None if there is nothing to do."""
+    user_id = job["user_id"]
+    file = job["file_name"]
+    file_name = join(ROOT, "data", "in", user_id, file)
+
+    # Skip files that have been deleted or already processed
+    if not isfile(file_name):
+        if time.time() - (job["created"] or 0) < PLACE_TIME:
+            # The web app queues an upload right before it moves the file into data/in
+            jobs.release_job(job["id"])
+            time.sleep(0.1)
+            return None
+        jobs.delete_job(user_id, file)
+        media.forget(file_name)
+        return None
+    if isfile(join(ROOT, "data", "out", user_id, file + ".html")):
+        jobs.finish_job(user_id, file)
+        return None
+
+    language, hotwords = job_options(user_id, file)
+    scratch_dir = join(ROOT, "data", "worker", "jobs", str(job["id"]))
+    resumed = prepare_scratch_dir(scratch_dir, file_name)
+    return {
+        "job": job,
+        "user_id": user_id,
+        "file": file,
+        "file_name": file_name,
+        "language": language,
+        "hotwords": hotwords,
+        "is_zip": file_name.lower().endswith(".zip"),
+        "estimated_time": 0,
+        "duration": None,
+        "stage_estimates": None,
+        "timings": {},
+        "speakers": None,
+        "tracks": [],
+        "scratch_dir": scratch_dir,
+        "resumed": resumed,
+        "cache_key": None,
+        "restored": False,
+        "mixdown": None,
+        "progress": (None, 0.0, 0.0),
+        "fractions": {},
+        "lock": threading.Lock(),
+    }
+
+
+def restore_result(ctx):
+    """Finish a job from the result cache if the same content was transcribed with the same options before."""
+    if not cache.RESULT_CACHE:
+        return False
+    content_hash = ctx["job"]["content_hash"] or cache.hash_file(ctx["file_name"])
+    ctx["cache_key"] = cache.result_key(content_hash, ctx["language"], ctx["hotwords"])
+    cached = cache.lookup(ctx["cache_key"])
+    if cached is None:
+        return False
+
+    segments, srt, preview_file = cached
+    out_dir = join(ROOT, "data", "out", ctx["user_id"])
+    os.makedirs(out_dir, exist_ok=True)
+    file_name_out = join(out_dir, ctx["file"] + ".mp4")
+    if preview_file is not None:
+        cache.link_or_copy(preview_file, file_name_out)
+    else:
+        create_preview(ctx["file_name"], file_name_out)
+    write_results(ctx, segments, srt)
+    logger.info(f"Restored {ctx['file']} from the result cache")
+    return True
 
-    # Check if file has a valid audio stream
+
+def restore(ctx):
+    """First stage: finish the job from the result cache, hashing the upload on the ingest threads."""
     try:
-        if not ffmpeg.probe(file_name, select_streams="a")["streams"]:
-            report_error(
-                file_name,
-                file_name_error,
-                user_id,
-                "Die Tonspur der Datei konnte nicht gelesen werden",
-            )
-            return data, estimated_time, progress_file_name
-    except ffmpeg.Error as e:
-        logger.exception("ffmpeg error during probing")
-        report_error(
-            file_name,
-            file_name_error,
-            user_id,
-            "Die Tonspur der Datei konnte nicht gelesen werden",
-        )
-        return data, estimated_time, progress_file_name
+        ctx["restored"] = restore_result(ctx)
+    except Exception:
+        logger.exception("Error reading the result cache")
+    return ctx
+
+
+def ingest(ctx):
+    """Check the upload, create the preview video for the editor and load the audio of all tracks."""
+    os.makedirs(join(ROOT, "data", "out", ctx["user_id"]), exist_ok=True)
+    report_progress(ctx, "ingest")
+    if ctx["is_zip"]:
+        ingest_zip(ctx)
+    else:
+        ingest_file(ctx)
 
-    # Process audio
-    if not multi_mode:
-        # Convert and filter audio
-        exit_status = os.system(
-            f'ffmpeg -y -i "{file_name}" -filter:v scale=320:-2 -af "lowpass=3000,highpass=200" "{file_name_out}"'
+    if diarization_executor is not None:
+        # Diarization only needs the audio, so it runs while the transcript is created
+        for i, track in enumerate(ctx["tracks"]):
+            track["diarization"] = diarization_executor.submit(diarize_track, ctx, i)
+    return ctx
+
+
+def ingest_file(ctx):
+    run_time = check_audio(ctx["file_name"])
+    estimate_job(ctx, run_time)
+
+    audio = load_audio(
+        ctx["file_name"],
+        join(ctx["scratch_dir"], "audio.f32"),
+        join(ROOT, "data", "out", ctx["user_id"], ctx["file"] + ".mp4"),
+        run_time,
+        lambda fraction: report_progress(ctx, "ingest", fraction),
+    )
+    ctx["tracks"] = [{"path": ctx["file_name"], "audio": audio}]
+
+
+def zip_members(zip_ref):
+    """Return the audio and video files of a zip file in name order and enforce the limits of zip uploads."""
+    members = [
+        member
+        for member in zip_ref.infolist()
+        if not member.is_dir()
+        and splitext(member.filename)[1].lower() in MEDIA_EXTENSIONS
+        and not basename(member.filename).startswith(".")
+        and not member.filename.startswith("__MACOSX/")
+    ]
+    members.sort(key=lambda member: member.filename)
+    if not members:
+        raise JobError("Die ZIP-Datei enthält keine Audio- oder Videodateien")
+    if len(members) > ZIP_MAX_MEMBERS:
+        raise JobError(f"Die ZIP-Datei enthält mehr als {ZIP_MAX_MEMBERS} Audio- oder Videodateien")
+    if sum(member.file_size for member in members) > ZIP_MAX_BYTES:
+        raise JobError("Die ZIP-Datei ist zu gross")
+    return members
+
+
+def extract_member(zip_ref, member, file_name, limit):
+    """Stream a member of a zip file to disk and return its size. The size in the zip header is not trusted."""
+    written = 0
+    with zip_ref.open(member) as source, open(file_name, "wb") as target:
+        for chunk in iter(lambda: source.read(1024 * 1024), b""):
+            written += len(chunk)
+            if written > limit:
+                raise JobError("Die ZIP-Datei ist zu gross")
+            target.write(chunk)
+    return written
+
+
+def decode_track(file_name, pcm_file):
+    """Check and decode a track of a zip file, then remove the extracted file. Return its length and audio."""
+    duration = check_audio(file_name, cached=False)
+    audio = load_audio(file_name, pcm_file)
+    os.remove(file_name)
+    return duration, audio
+
+
+def ingest_zip(ctx):
+    """Stream the tracks of a zip file, one speaker per track, into the scratch directory of the job.
+
+    Every track is decoded as soon as it is extracted, while the next one is extracted. Then the voices
+    are isolated on the decoded audio and the tracks are mixed down for the editor.
+    """
+    scratch_dir = ctx["scratch_dir"]
+    manifest_file = join(scratch_dir, "tracks.json")
+    durations = load_checkpoint(manifest_file)
+    if durations is not None:
+        # An earlier attempt of the job already prepared the tracks
+        estimate_job(ctx, sum(durations))
+        pcm_files = [join(scratch_dir, f"track_{i}.f32") for i in range(len(durations))]
+        ctx["tracks"] = [{"path": None, "audio": load_pcm(pcm_file)} for pcm_file in pcm_files]
+        start_mixdown(ctx, pcm_files)
+        return
+
+    zip_extract_dir = join(scratch_dir, "zip")
+    os.makedirs(zip_extract_dir, exist_ok=True)
+    with zipfile.ZipFile(ctx["file_name"], "r") as zip_ref, ThreadPoolExecutor(
+        max_workers=ZIP_DECODE_THREADS, thread_name_prefix="unzip"
+    ) as executor:
+        members = zip_members(zip_ref)
+        remaining = ZIP_MAX_BYTES
+        decoding = []
+        for i, member in enumerate(members):
+            track_file = join(zip_extract_dir, f"track_{i}{splitext(member.filename)[1].lower()}")
+            remaining -= extract_member(zip_ref, member, track_file, remaining)
+            decoding.append(executor.submit(decode_track, track_file, join(scratch_dir, f"track_{i}.raw.f32")))
+            report_progress(ctx, "ingest", 0.5 * (i + 1) / len(members))
+        decoded = [future.result() for future in decoding]
+
+    durations = [duration for duration, _ in decoded]
+    estimate_job(ctx, sum(durations))
+
+    pcm_files = [join(scratch_dir, f"track_{i}.f32") for i in range(len(decoded))]
+    audios = isolate_voices([audio for _, audio in decoded], pcm_files)
+    del decoded
+    for i in range(len(pcm_files)):
+        os.remove(join(scratch_dir, f"track_{i}.raw.f32"))
+
+    save_checkpoint(manifest_file, durations)
+    # The isolated tracks are transcribed from memory, mlx_whisper included
+    ctx["tracks"] = [{"path": None, "audio": audio} for audio in audios]
+    start_mixdown(ctx, pcm_files)
+
+
+def start_mixdown(ctx, pcm_files):
+    """Mix the isolated tracks of a zip file down into the preview for the editor, in the background."""
+    preview_file = join(ROOT, "data", "out", ctx["user_id"], ctx["file"] + ".mp4")
+    if not isfile(preview_file):
+        ctx["mixdown"] = preview_executor.submit(mix_preview, pcm_files, preview_file)
+
+
+def wait_for_mixdown(ctx):
+    """Wait until the preview of a zip file is mixed down, the editor and the result cache link to it."""
+    if ctx["mixdown"] is not None and not ctx["mixdown"].result():
+        logger.error("ffmpeg error during preview processing")
+    ctx["mixdown"] = None
+
+
+def checkpoint_file(ctx, index, stage):
+    """Return the file in which a stage saves its output for a track, so that a restarted job resumes there."""
+    return join(ctx["scratch_dir"], f"track_{index}.{stage}.json")
+
+
+def for_each_track(ctx, function):
+    """Call function(index, track) for every track, for the tracks of a zip file up to TRACK_THREADS at a time."""
+    if len(ctx["tracks"]) < 2 or TRACK_THREADS < 2:
+        for i, track in enumerate(ctx["tracks"]):
+            function(i, track)
+        return
+    with ThreadPoolExecutor(max_workers=TRACK_THREADS, thread_name_prefix="track") as executor:
+        # Consume the results to raise the first exception of a track
+        list(executor.map(function, range(len(ctx["tracks"])), ctx["tracks"]))
+
+
+def asr(ctx):
+    def asr_track(i, track):
+        track["result1"] = load_checkpoint(checkpoint_file(ctx, i, "asr"))
+        if track["result1"] is not None:
+            logger.info(f"Resuming track {i} after transcription")
+            return
+        report_progress(ctx, "asr", 0.0, i)
+        track["result1"] = run_asr(
+            track["audio"],
+            model,
+            ctx["hotwords"],
+            BATCH_SIZE,
+            ctx["language"],
+            track["path"],
+            lambda fraction: report_progress(ctx, "asr", fraction, i),
         )
-        if exit_status == 256:
-            exit_status = os.system(
-                f'ffmpeg -y -i "{file_name}" -c:v copy -af "lowpass=3000,highpass=200" "{file_name_out}"'
+        save_checkpoint(checkpoint_file(ctx, i, "asr"), track["result1"])
+        report_progress(ctx, "asr", 1.0, i)
+
+    for_each_track(ctx, asr_track)
+    return ctx
+
+
+def align(ctx):
+    def align_track(i, track):
+        track["result2"] = load_checkpoint(checkpoint_file(ctx, i, "align"))
+        if track["result2"] is not None:
+            logger.info(f"Resuming track {i} after alignment")
+            return
+        report_progress(ctx, "align", 0.0, i)
+        track["result2"] = run_alignment(track["result1"], track["audio"], DEVICE)
+        if ADD_LANGUAGE:
+            add_languages(
+                track["result2"],
+                track["audio"],
+                model,
+                ctx["hotwords"],
+                ctx["language"],
+                BATCH_SIZE,
+                track["result1"].get("windows"),
             )
-        if not exit_status == 0:
-            logger.exception("ffmpeg error during audio processing")
-            file_name_out = file_name  # Fallback to original file
+        save_checkpoint(checkpoint_file(ctx, i, "align"), track["result2"])
+        report_progress(ctx, "align", 1.0, i)
+
+    for_each_track(ctx, align_track)
+    return ctx
+
+
+def diarize_track(ctx, index, on_progress=None):
+    """Return the speaker turns of a track, from its checkpoint if it was diarized before."""
+    diarize_df = load_diarization(checkpoint_file(ctx, index, "diarize"))
+    if diarize_df is not None:
+        logger.info(f"Resuming track {index} after diarization")
+        return diarize_df
+    diarize_df = run_diarization(ctx["tracks"][index]["audio"], diarize_model, on_progress=on_progress)
+    save_diarization(checkpoint_file(ctx, index, "diarize"), diarize_df)
+    return diarize_df
+
+
+def speaker_count(diarize_df):
+    """Return the number of speaker labels of a diarization, SPEAKER_00 to the highest label."""
+    labels = [int(speaker.split("_")[1]) for speaker in set(diarize_df["speaker"])]
+    return max(labels) + 1 if labels else 0
+
+
+def diarize(ctx):
+    # Speakers of different tracks get different labels
+    num_speakers_detected = 0 if ctx["is_zip"] else None
+    for i, track in enumerate(ctx["tracks"]):
+        report_progress(ctx, "diarize", 0.0, i)
+        if "diarization" in track:
+            # Started in the background during the ingest
+            diarize_df = track.pop("diarization").result()
+        else:
+            diarize_df = diarize_track(ctx, i, lambda fraction: report_progress(ctx, "diarize", fraction, i))
+        result3 = assign_speakers(diarize_df, track["result2"], num_speakers_detected)
+        track["segments"] = clean_segments(result3, track["result1"]["language"])
+        if num_speakers_detected is not None:
+            # The offset of the next track only depends on the speakers found in this track's diarization,
+            # not on which of them are left after cleaning or on the order in which tracks finished
+            num_speakers_detected += speaker_count(diarize_df)
+        del track["audio"]
+    empty_cache()
+    return ctx
+
+
+def render(ctx):
+    """Merge the tracks and write the editor and the SRT file."""
+    report_progress(ctx, "render")
+    user_id = ctx["user_id"]
+    file = ctx["file"]
+
+    # The segments of each track are sorted, merge them by start time. Equal start times keep the track order.
+    data = list(heapq.merge(*[track["segments"] for track in ctx["tracks"]], key=lambda segment: segment["start"]))
+
+    ctx["speakers"] = len({segment.get("speaker") for segment in data})
+    file_name_out = join(ROOT, "data", "out", user_id, file + ".mp4")
+    srt = create_srt(data)
+    wait_for_mixdown(ctx)
+    write_results(ctx, data, srt)
+    if ctx["cache_key"] is not None:
+        cache.store(ctx["cache_key"], data, srt, file_name_out)
 
-    else:
-        file_name_out = file_name
+    logger.info(f"Estimated Time: {ctx['estimated_time']}")
+    return ctx
 
-    # Load hotwords
-    hotwords = []
-    hotwords_file = join(ROOT, "data", "in", user_id, "hotwords.txt")
-    if isfile(hotwords_file):
-        with open(hotwords_file, "r") as h:
-            hotwords = h.read().splitlines()
 
-    # Transcribe
+def write_results(ctx, data, srt):
+    """Write the transcript file, the editor and the SRT file and mark the job as done."""
+    user_id = ctx["user_id"]
+    file = ctx["file"]
+    file_name_out = join(ROOT, "data", "out", user_id, file + ".mp4")
+    file_name_viewer = join(ROOT, "data", "out", user_id, file + ".html")
+    file_name_srt = join(ROOT, "data", "out", user_id, file + ".srt")
+
+    # The exports are rendered from the transcript file, it is written before the editor marks the job as done
+    transcript.save(
+        join(ROOT, "data", "out", user_id, file + ".jsonl"),
+        [transcript.from_worker(segment, ctx["language"], i) for i, segment in enumerate(data)],
+    )
+
+    # The editor contains the file name and the date, so it is rendered for every job
+    viewer = create_viewer(data, file_name_out, True, False, ROOT, ctx["language"])
+    with open(file_name_viewer, "w", encoding="utf-8") as f:
+        f.write(viewer)
+    with open(file_name_srt, "w", encoding="utf-8") as f:
+        f.write(srt)
+    jobs.finish_job(user_id, file)
+
+
+def cleanup(ctx):
+    for track in ctx["tracks"]:
+        if "diarization" in track:
+            track["diarization"].cancel()
+    if ctx["mixdown"] is not None:
+        ctx["mixdown"].cancel()
+        ctx["mixdown"] = None
+    ctx["tracks"] = []
+    if ctx["scratch_dir"]:
+        shutil.rmtree(ctx["scratch_dir"], ignore_errors=True)
+
+
+def timed(stage, function):
+    """Record the run time of a stage in the job context for the estimator. Restored jobs skip the stage."""
+
+    def run(ctx):
+        if ctx["restored"]:
+            return ctx
+        start = time.time()
+        ctx = function(ctx)
+        ctx["timings"][stage] = time.time() - start
+        return ctx
+
+    return run
+
+
+def record_timings(ctx):
+    """Let the estimator learn from the run time of the stages of a job that ran from start to end."""
+    if ctx["resumed"] or ctx["duration"] is None or set(ctx["timings"]) != set(estimator.STAGES):
+        return
     try:
-        data = transcribe(
-            file_name_out,
-            model,
-            diarize_model,
-            DEVICE,
-            None,
-            add_language=(
-                False if DEVICE == "mps" else True
-            ),  # on MPS is rather slow and unreliable, but you can try with setting this to true
-            hotwords=hotwords,
-            batch_size=BATCH_SIZE,
-            num_speakers_detected=num_speakers_detected,
-            language=language,
+        estimator.record(
+            ctx["job"]["id"],
+            ctx["duration"],
+            ctx["timings"],
+            ctx["stage_estimates"],
+            ctx["speakers"],
+            ctx["language"],
         )
-    except Exception as e:
-        logger.exception("Transcription failed")
-        report_error(
-            file_name, file_name_error, user_id, "Transkription fehlgeschlagen"
-        )
-
-    return data, estimated_time, progress_file_name
+        # Queued jobs are estimated again with the updated regression
+        jobs.clear_estimates()
+        count, error = estimator.error_stats(estimator.HOST)
+        if error is not None:
+            logger.info(f"Run time estimates of the last {count} jobs on this host were off by {error:.0%}")
+    except Exception:
+        logger.exception("Could not record the run time of the job")
+
+
+def job_done(ctx):
+    cleanup(ctx)
+    record_timings(ctx)
+    lease.release(ctx["job"]["id"])
+
+
+def job_failed(ctx, stage, exception):
+    cleanup(ctx)
+    if isinstance(exception, JobError):
+        text = str(exception)
+    elif stage == "render":
+        text = "Fehler beim Erstellen des Editors"
+    else:
+        text = "Transkription fehlgeschlagen"
+    try:
+        report_error(ctx["file_name"], join(ROOT, "data", "error", ctx["user_id"], ctx["file"]), ctx["user_id"], text)
+    finally:
+        lease.release(ctx["job"]["id"])
 
 
 def summarize(text, llm, encoder):
@@ -243,19 +731,33 @@ if __name__ == "__main__":
     whisperx_model = (
         "tiny.en" if DEVICE == "mps" else "large-v3"
     )  # we can load a really small one for mps, because we use mlx_whisper later and only need whisperx for diarization and alignment
-    if ONLINE:
-        model = whisperx.load_model(
-            whisperx_model, WHISPER_DEVICE, compute_type=compute_type
-        )
-    else:
-        model = whisperx.load_model(
+    download_root = None if ONLINE else join("models", "whisperx")
+    whisper_model = None
+    if TRACK_THREADS > 1 and DEVICE != "mps":
+        # With several CTranslate2 workers, the tracks of a zip file are transcribed in parallel
+        whisper_model = WhisperModel(
             whisperx_model,
-            WHISPER_DEVICE,
+            device=WHISPER_DEVICE,
             compute_type=compute_type,
-            download_root=join("models", "whisperx"),
+            download_root=download_root,
+            cpu_threads=ASR_THREADS,
+            num_workers=TRACK_THREADS,
         )
+    model = whisperx.load_model(
+        whisperx_model,
+        WHISPER_DEVICE,
+        compute_type=compute_type,
+        download_root=download_root,
+        threads=ASR_THREADS,
+        model=whisper_model,
+    )
 
+    if DIARIZE_THREADS > 0:
+        torch.set_num_threads(DIARIZE_THREADS)
     model.model.get_prompt = types.MethodType(get_prompt, model.model)
+    if DEVICE != "mps":
+        install_language_capture(model)
+        install_progress_hooks(model)
     diarize_model = Pipeline.from_pretrained(
         "pyannote/speaker-diarization", use_auth_token=os.getenv("HF_AUTH_TOKEN")
     ).to(torch.device(DEVICE))
@@ -295,196 +797,95 @@ if __name__ == "__main__":
         "us harmless from any action, claims, liability or loss in respect of your use of the Software."
     )
     logger.info(disclaimer)
+    jobs.import_existing(ROOT)
+    transcript.import_existing(ROOT)
+    intake = JobIntake(ROOT)
+    intake.start()
     logger.info("Worker ready")
 
+    lease = jobs.LeaseKeeper(WORKER_ID)
+    lease.start()
+
+    pipeline = StagePipeline(
+        [
+            ("restore", restore, INGEST_THREADS),
+            ("ingest", timed("ingest", ingest), INGEST_THREADS),
+            ("asr", timed("asr", asr), 1),
+            ("align", timed("align", align), 1),
+            ("diarize", timed("diarize", diarize), 1),
+            ("render", timed("render", render), 1),
+        ],
+        max_jobs=PIPELINE_DEPTH,
+        on_done=job_done,
+        on_error=job_failed,
+    )
+    if DEVICE != "mps":
+        pipeline.start()
+
     while True:
         try:
-            files_sorted_by_date = oldest_files(join(ROOT, "data", "in"))
+            intake.poll()
+            for file_name in intake.drain():
+                if not isfile(file_name):
+                    continue
+                user_id = normpath(dirname(file_name)).split(os.sep)[-1]
+                jobs.ensure_job(user_id, basename(file_name), created=os.path.getmtime(file_name))
+            estimate_jobs()
         except Exception as e:
             logger.exception("Error accessing input directory")
             time.sleep(1)
             continue
 
-        for file_name in files_sorted_by_date:
-            file = basename(file_name)
-            user_id = normpath(dirname(file_name)).split(os.sep)[-1]
-
-            if file == "hotwords.txt" or file == "language.txt":
-                continue
-
-            file_name_viewer = join(ROOT, "data", "out", user_id, file + ".html")
-
-            # Skip files that have already been processed
-            if not isfile(file_name) or isfile(file_name_viewer):
-                continue
-
-            language_file = join(ROOT, "data", "in", user_id, "language.txt")
-            if isfile(language_file):
-                with open(language_file, "r") as h:
-                    language = h.read()
-            else:
-                language = "de"
-
-            # Check if it's a zip file
-            if file_name.lower().endswith(".zip"):
-                try:
-                    zip_extract_dir = join(ROOT, "data", "worker", "zip")
-                    shutil.rmtree(zip_extract_dir, ignore_errors=True)
-                    os.makedirs(zip_extract_dir, exist_ok=True)
-
-                    with zipfile.ZipFile(file_name, "r") as zip_ref:
-                        zip_ref.extractall(zip_extract_dir)
-
-                    multi_mode = True
-                    data_parts = []
-                    estimated_time = 0
-                    data = []
-                    file_parts = []
-
-                    # Collect files from zip
-                    for root, _, filenames in os.walk(zip_extract_dir):
-                        audio_files = [
-                            fn for fn in filenames if fnmatch.fnmatch(fn, "*.*")
-                        ]
-                        for filename in audio_files:
-                            file_path = join(root, filename)
-                            est_time_part, _ = time_estimate(file_path, ONLINE)
-                            estimated_time += est_time_part
-
-                    progress_file_name = join(
-                        ROOT,
-                        "data",
-                        "worker",
-                        user_id,
-                        f"{estimated_time}_{int(time.time())}_{file}",
-                    )
-                    with open(progress_file_name, "w") as f:
-                        f.write("")
-
-                    isolate_voices([join(root, filename) for filename in audio_files])
-
-                    num_speakers_detected = 0
-                    # Transcribe each file
-                    for filename in audio_files:
-                        file_path = join(root, filename)
-                        file_parts.append(f'-i "{file_path}"')
-                        data_part, _, _ = transcribe_file(
-                            file_path,
-                            multi_mode=True,
-                            num_speakers_detected=num_speakers_detected,
-                            language=language,
-                        )
-                        num_speakers_detected += len(set([segment['speaker'] for segment in data_part]))
-                        data_parts.append(data_part)
-
-                    # Merge data
-                    while any(data_parts):
-                        earliest = min(
-                            [(i, dp[0]) for i, dp in enumerate(data_parts) if dp],
-                            key=lambda x: x[1]["start"],
-                            default=(None, None),
-                        )
-                        if earliest[0] is None:
-                            break
-
-                        data.append(earliest[1])
-                        data_parts[earliest[0]].pop(0)
-
-                    # Merge audio files
-                    output_audio = join(ROOT, "data", "worker", "zip", "tmp.mp4")
-                    ffmpeg_input = " ".join(file_parts)
-                    ffmpeg_cmd = f'ffmpeg {ffmpeg_input} -filter_complex amix=inputs={len(file_parts)}:duration=first "{output_audio}"'
-                    os.system(ffmpeg_cmd)
-
-                    # Process merged audio
-                    file_name_out = join(ROOT, "data", "out", user_id, file + ".mp4")
-                    exit_status = os.system(
-                        f'ffmpeg -y -i "{output_audio}" -filter:v scale=320:-2 -af "lowpass=3000,highpass=200" "{file_name_out}"'
-                    )
-                    if exit_status == 256:
-                        exit_status = os.system(
-                            f'ffmpeg -y -i "{output_audio}" -c:v copy -af "lowpass=3000,highpass=200" "{file_name_out}"'
-                        )
-                    if not exit_status == 0:
-                        logger.exception("ffmpeg error during audio processing")
-                        file_name_out = output_audio  # Fallback to original fileue)
-
-                    shutil.rmtree(zip_extract_dir, ignore_errors=True)
-                except Exception as e:
-                    logger.exception("Transcription failed for zip file")
-                    report_error(
-                        file_name,
-                        join(ROOT, "data", "error", user_id, file),
-                        user_id,
-                        "Transkription fehlgeschlagen",
-                    )
-                    continue
-            else:
-                # Single file transcription
-                data, estimated_time, progress_file_name = transcribe_file(
-                    file_name, language=language
-                )
-
-            if data is None:
+        # Lease a new job as soon as the pipeline has room for it, so that the next job is
+        # preprocessed while the current one is on the model
+        job = jobs.claim_job(WORKER_ID) if not pipeline.full() else None
+        if job is not None:
+            lease.hold(job["id"])
+            ctx = job_context(job)
+            if ctx is None:
+                lease.release(job["id"])
                 continue
-
-            # Generate outputs
-            try:
-                file_name_out = join(ROOT, "data", "out", user_id, file + ".mp4")
-
-                srt = create_srt(data)
-                viewer = create_viewer(data, file_name_out, True, False, ROOT, language)
-
-                file_name_srt = join(ROOT, "data", "out", user_id, file + ".srt")
-                with open(file_name_viewer, "w", encoding="utf-8") as f:
-                    f.write(viewer)
-                with open(file_name_srt, "w", encoding="utf-8") as f:
-                    f.write(srt)
-
-                logger.info(f"Estimated Time: {estimated_time}")
-            except Exception as e:
-                logger.exception("Error creating editor")
-                report_error(
-                    file_name,
-                    join(ROOT, "data", "error", user_id, file),
-                    user_id,
-                    "Fehler beim Erstellen des Editors",
-                )
-
-            if progress_file_name and os.path.exists(progress_file_name):
-                os.remove(progress_file_name)
             if DEVICE == "mps":
+                pipeline.run(ctx)
                 print("Exiting worker to prevent memory leaks with MPS...")
                 exit(
                     0
                 )  # Due to memory leak problems, we restart the worker after each transcription
-
-            break  # Process one file at a time
-
-        try:
-            files_sorted_by_date = oldest_files(join(ROOT, "data", "out"))
-        except Exception as e:
-            logger.exception("Error accessing input directory")
-            time.sleep(1)
+            pipeline.submit(ctx)
             continue
 
         if SUMMARIZATION:
-            for file_name in files_sorted_by_date:
-                if file_name.endswith(".todosummary"):
-                    logger.info(f"Summarizing file")
-                    try:
-                        content_out, lines = read_content_summary(file_name)
-                        summary = summarize(content_out, llm, encoder)
-                    except Exception as e:
-                        logger.exception("Summarization failed")
-                        summary = (
-                            "Zusammenfassung fehlgeschlagen. Bitte versuche es erneut."
-                        )
-                    write_content_summary(
-                        summary, lines, file_name.replace(".todosummary", ".summary")
+            for file_name in intake.pending_summaries():
+                # Claim the summary by renaming it, so that only one worker processes it
+                file_name_claimed = file_name.replace(".todosummary", ".summarizing")
+                try:
+                    os.rename(file_name, file_name_claimed)
+                except OSError:
+                    intake.forget(file_name)
+                    continue
+                intake.forget(file_name)
+                logger.info(f"Summarizing file")
+                with open(file_name_claimed, "r", encoding="utf-8") as f:
+                    lines = f.read()
+                try:
+                    segments = transcript.load_result(file_name[: -len(".todosummary")])
+                    summary = summarize(transcript.summary_input(segments), llm, encoder)
+                except Exception as e:
+                    logger.exception("Summarization failed")
+                    summary = (
+                        "Zusammenfassung fehlgeschlagen. Bitte versuche es erneut."
                     )
-                    os.remove(file_name)
-                    logger.info(f"Summarizing done")
-                    break
+                write_content_summary(
+                    summary, lines, file_name.replace(".todosummary", ".summary")
+                )
+                # The web app makes the summary available for download once it is in the job index
+                jobs.set_summary(
+                    basename(dirname(file_name)),
+                    basename(file_name)[: -len(".todosummary")],
+                    jobs.SUMMARY_WRITTEN,
+                )
+                os.remove(file_name_claimed)
+                logger.info(f"Summarizing done")
+                break
 
         time.sleep(1)